@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Single forwarder shipping the events of several worker processes.
+
+Workers connect to a local unix socket instead of fluentd, and the forwarder
+writes what they send to fluentd with one connection and one buffer for the
+whole host::
+
+    $ python -m aiofluent.forwarder /run/aiofluent.sock --host fluentd --port 24224
+
+Workers send through :func:`connection_factory`, which prefixes every packet
+with its length so packets of different workers are never interleaved::
+
+    sender.setup('app', host='unix:///run/aiofluent.sock',
+                 connection_factory=forwarder.connection_factory)
+"""
+
+import argparse
+import asyncio
+import os
+import stat
+import struct
+import sys
+
+from aiofluent import sender as _sender
+
+READ_SIZE = 256 * 1024
+# length of the packet that follows
+_FRAME_HEADER = struct.Struct(">I")
+
+
+class _FramedWriter(object):
+    """Stream writer prefixing every packet with its length"""
+
+    def __init__(self, writer):
+        self._writer = writer
+
+    def write(self, data):
+        self._writer.writelines((_FRAME_HEADER.pack(len(data)), data))
+
+    def writelines(self, chunks):
+        framed = []
+        for chunk in chunks:
+            framed.append(_FRAME_HEADER.pack(len(chunk)))
+            framed.append(chunk)
+        self._writer.writelines(framed)
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+
+async def connection_factory(sender):
+    """Connection of a worker sender to the forwarder at `sender._host`"""
+    result = await _sender.connection_factory(sender)
+    if result:
+        reader, writer = result
+        return reader, _FramedWriter(writer)
+
+
+def _split_frames(buffer):
+    """Complete packets at the start of `buffer` and the bytes they use"""
+    packets = []
+    offset = 0
+    while len(buffer) - offset >= _FRAME_HEADER.size:
+        (size,) = _FRAME_HEADER.unpack_from(buffer, offset)
+        start = offset + _FRAME_HEADER.size
+        end = start + size
+        if end > len(buffer):
+            break
+        packets.append(bytes(buffer[start:end]))
+        offset = end
+    return packets, offset
+
+
+class Forwarder(object):
+    """Receive packets of workers on the unix socket `path` and send them on.
+
+    Packets are forwarded as they are, everything read from a worker at once
+    is written with a single call. Extra keyword arguments are passed to the
+    :class:`FluentSender` connected to fluentd, e.g. `spill_dir`.
+    """
+
+    def __init__(self, path, host="localhost", port=24224, **kwargs):
+        self.path = path
+        self.sender = _sender.FluentSender("", host=host, port=port, **kwargs)
+        self._server = None
+
+    async def start(self):
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            # left behind by a previous forwarder
+            os.remove(self.path)
+        self._server = await asyncio.start_unix_server(self._handle, self.path)
+
+    async def _handle(self, reader, writer):
+        buffer = bytearray()
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                buffer += data
+                packets, used = _split_frames(buffer)
+                del buffer[:used]
+                if packets:
+                    # not reading while fluentd is slow holds the workers up
+                    await self.sender._async_send(packets)
+        finally:
+            writer.close()
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        await self.sender.flush()
+        self.sender.close()
+
+
+async def _serve(args):
+    forwarder = Forwarder(
+        args.path,
+        host=args.host,
+        port=args.port,
+        timeout=args.timeout,
+        spill_dir=args.spill_dir,
+    )
+    try:
+        await forwarder.serve_forever()
+    finally:
+        await forwarder.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Forward worker events to fluentd")
+    parser.add_argument("path", help="unix socket the workers connect to")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=24224)
+    parser.add_argument("--timeout", type=float, default=3)
+    parser.add_argument("--spill-dir", default=None)
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,37 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import collections
 import json
 import logging
+import os
+import re
 import socket
 import sys
+import threading
 import time
 import traceback
+import weakref
 
 from aiofluent import sender
+from aiofluent.ratelimit import RateLimiter
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# `%(attr)s` values are read straight from the record
+_PLAIN_FIELD = re.compile(r"^%\((\w+)\)s$")
+_FIELD_NAME = re.compile(r"%\((\w+)\)")
+
+# orjson is used to decode JSON messages when it is installed
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+# threaded handlers of the process, restarted in the child after a fork
+_threaded_handlers = weakref.WeakSet()
+# open handlers sharing the log queue, its consumer stops with the last one
+_queue_handlers = weakref.WeakSet()
 
 
 class FluentRecordFormatter(logging.Formatter, object):
@@ -17,10 +40,17 @@ class FluentRecordFormatter(logging.Formatter, object):
     Best used with server storing data in an ElasticSearch cluster for example.
 
     :param fmt: a dict with format string as values to map to provided keys.
+    :param parse_json: merge string messages holding a JSON object into the
+      record, only messages starting with `{` are decoded.
+
+    The format strings are compiled once: plain `%(attr)s` values are copied
+    from the record, `message`, `asctime` and `exc_text` are only computed
+    when a value refers to them.
     """
 
-    def __init__(self, fmt=None, datefmt=None, style="%"):
+    def __init__(self, fmt=None, datefmt=None, style="%", parse_json=True):
         super(FluentRecordFormatter, self).__init__(None, datefmt)
+        self.parse_json = parse_json
 
         if not fmt:
             self._fmt_dict = {
@@ -32,17 +62,43 @@ class FluentRecordFormatter(logging.Formatter, object):
             self._fmt_dict = fmt
 
         self.hostname = socket.gethostname()
+        self._compile()
+
+    def _compile(self):
+        # (key, attribute, None) for plain values, (key, None, template) else
+        self._fields = []
+        names = set()
+        for key, value in self._fmt_dict.items():
+            plain = _PLAIN_FIELD.match(value)
+            if plain is not None:
+                self._fields.append((key, plain.group(1), None))
+            else:
+                self._fields.append((key, None, value))
+            names.update(_FIELD_NAME.findall(value))
+        self._uses_message = "message" in names
+        self._uses_time = "asctime" in names
+        self._uses_exc_text = "exc_text" in names
 
     def format(self, record):
-        # Compute attributes handled by parent class.
-        super(FluentRecordFormatter, self).format(record)
+        # Compute the attributes handled by parent class that are used
+        if self._uses_message:
+            record.message = record.getMessage()
+        if self._uses_time:
+            record.asctime = self.formatTime(record, self.datefmt)
+        if self._uses_exc_text and record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
         # Add ours
         record.hostname = self.hostname
         # Apply format
+        attrs = record.__dict__
         data = {}
-        for key, value in self._fmt_dict.items():
+        for key, attr, template in self._fields:
+            if template is None:
+                if attr in attrs:
+                    data[key] = str(attrs[attr])
+                continue
             try:
-                data[key] = value % record.__dict__
+                data[key] = template % attrs
             except (KeyError, TypeError):
                 # we are okay with missing values here...
                 pass
@@ -51,7 +107,7 @@ class FluentRecordFormatter(logging.Formatter, object):
         return data
 
     def usesTime(self):
-        return any([value.find("%(asctime)") >= 0 for value in self._fmt_dict.values()])
+        return self._uses_time
 
     def _structuring(self, data, record):
         """Melds `msg` into `data`.
@@ -67,11 +123,13 @@ class FluentRecordFormatter(logging.Formatter, object):
         if isinstance(msg, dict):
             self._add_dic(data, msg)
         elif isinstance(msg, str):
-            try:
-                self._add_dic(data, json.loads(str(msg)))
-            except ValueError:
-                msg = record.getMessage()
-                self._add_dic(data, {"message": msg})
+            if self.parse_json and msg.lstrip().startswith("{"):
+                try:
+                    self._add_dic(data, _json_loads(msg))
+                    return
+                except ValueError:
+                    pass
+            self._add_dic(data, {"message": record.getMessage()})
         else:
             self._add_dic(data, {"message": msg})
 
@@ -83,41 +141,233 @@ class FluentRecordFormatter(logging.Formatter, object):
 
 
 MAX_QUEUE_SIZE = 500
+MAX_BATCH_SIZE = 100
+OVERFLOW_POLICIES = ("drop_newest", "drop_oldest", "drop_level")
+
+
+async def _emit_batch(batch):
+    """Emit `(record, handler, timestamp)` items, batched per handler"""
+    records = collections.OrderedDict()
+    for record, handler, timestamp in batch:
+        records.setdefault(handler, []).append((record, timestamp))
+    for handler, handler_records in records.items():
+        size = handler.batch_size
+        for start in range(0, len(handler_records), size):
+            end = start + size
+            chunk = handler_records[start:end]
+            try:
+                await handler.async_emit_batch(chunk)
+            except:  # noqa
+                sys.stderr.write(
+                    "Error processing log\n{}\n".format(traceback.format_exc())
+                )
+            finally:
+                handler._records_sent(len(chunk))
+
+
+class _RecordQueue(asyncio.Queue):
+    def evict(self, predicate=None):
+        """Remove and return the oldest item matching `predicate`"""
+        for item in self._queue:
+            if predicate is None or predicate(item):
+                self._queue.remove(item)
+                self.task_done()
+                return item
+        return None
+
+    def count(self, predicate):
+        return sum(1 for item in self._queue if predicate(item))
+
+
+class _Repeats(object):
+    __slots__ = ("first", "until", "count", "last")
+
+    def __init__(self, record, window):
+        self.first = record.created
+        self.until = record.created + window
+        self.count = 0
+        self.last = None
+
+
+class RepeatCollapser(object):
+    """Collapse records logged again from the same call site.
+
+    Records are keyed on their logger, level, pathname, line number and
+    message template. The first one is sent, the repeats logged within
+    `window` seconds of it are counted instead, and a single summary record
+    is sent for them once the window is over: the last repeat, with
+    `repeat_count` repeats between `repeat_first` and `repeat_last`.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        # ordered by the end of their window
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def collapse(self, record):
+        """Whether `record` is sent, `False` for repeats"""
+        try:
+            key = (
+                record.name,
+                record.levelno,
+                record.pathname,
+                record.lineno,
+                record.msg,
+            )
+            hash(key)
+        except TypeError:
+            # dict messages are not collapsed
+            return True
+        with self._lock:
+            repeats = self._seen.get(key)
+            if repeats is None or record.created >= repeats.until:
+                self._seen.pop(key, None)
+                self._seen[key] = _Repeats(record, self.window)
+                return True
+            repeats.count += 1
+            repeats.last = record
+            return False
+
+    def expired(self, now=None):
+        """Summary records of the windows over at `now`"""
+        if now is None:
+            now = time.time()
+        summaries = []
+        with self._lock:
+            while self._seen:
+                key, repeats = next(iter(self._seen.items()))
+                if repeats.until > now:
+                    break
+                del self._seen[key]
+                if repeats.count:
+                    summaries.append(self._summary(repeats))
+        return summaries
+
+    def next_expiry(self):
+        """End of the first window still open, `None` when there is none"""
+        with self._lock:
+            for repeats in self._seen.values():
+                return repeats.until
+        return None
+
+    def flush(self):
+        """Summary records of every window, closing them"""
+        with self._lock:
+            seen, self._seen = self._seen, collections.OrderedDict()
+        return [self._summary(repeats) for repeats in seen.values() if repeats.count]
+
+    @staticmethod
+    def _summary(repeats):
+        # other handlers may hold the record, its attributes are not touched
+        attrs = dict(repeats.last.__dict__)
+        attrs["repeat_count"] = repeats.count
+        attrs["repeat_first"] = repeats.first
+        attrs["repeat_last"] = repeats.last.created
+        return logging.makeLogRecord(attrs)
 
 
 class LogQueue:
-    def __init__(self, queue=None):
+    """Records of every handler of the event loop, consumed by a single task.
+
+    Each handler has up to its own `queue_size` records queued, and the
+    queue as a whole up to `maxsize`, unbounded by default.
+    """
+
+    def __init__(self, queue=None, batch_size=MAX_BATCH_SIZE, maxsize=0):
         self._queue = queue
+        self._batch_size = batch_size
+        self._maxsize = maxsize
+        # queued records per handler
+        self._sizes = collections.Counter()
 
     async def consume_queue(self, initial_record, handler):
         if self._queue is None:
-            self._queue = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
-        self._queue.put_nowait((initial_record, handler, time.time()))
+            self._queue = _RecordQueue(maxsize=self._maxsize)
+        batch = [(initial_record, handler, time.time())]
+        queued = 0
         while True:
-            record, handler, timestamp = await self._queue.get()
+            # take whatever else is already queued along
+            while len(batch) < self._batch_size and not self._queue.empty():
+                batch.append(self._taken(self._queue.get_nowait()))
+                queued += 1
             try:
-                await handler.async_emit(record, timestamp)
-            except:  # noqa
-                sys.stderr.write(
-                    "Error processing log\n{}\n".format(traceback.format_exc())
-                )
+                await _emit_batch(batch)
             finally:
-                self._queue.task_done()
+                for _ in range(queued):
+                    self._queue.task_done()
+            batch = [self._taken(await self._queue.get())]
+            queued = 1
 
-    def qsize(self):
+    def _taken(self, item):
+        handler = item[1]
+        self._sizes[handler] -= 1
+        if self._sizes[handler] <= 0:
+            del self._sizes[handler]
+        return item
+
+    def qsize(self, handler=None):
+        """Number of queued records, only those of `handler` when given"""
         if self._queue is None:
             return 0
+        if handler is not None:
+            return self._sizes.get(handler, 0)
         return self._queue.qsize()
 
-    def put_nowait(self, *args):
-        self._queue.put_nowait(*args)
+    def count(self, predicate):
+        """Number of queued items matching `predicate`"""
+        if self._queue is None:
+            return 0
+        return self._queue.count(predicate)
+
+    async def join(self):
+        """Wait until every queued record was handed to its handler"""
+        if self._queue is not None:
+            await self._queue.join()
+
+    def put_nowait(self, item):
+        """Queue a `(record, handler, timestamp)` item, raises
+        `asyncio.QueueFull` past the `queue_size` of the handler"""
+        if self._queue is None:
+            # records logged before the consumer started
+            self._queue = _RecordQueue(maxsize=self._maxsize)
+        handler = item[1]
+        if self._sizes[handler] >= handler.queue_size:
+            raise asyncio.QueueFull
+        self._queue.put_nowait(item)
+        self._sizes[handler] += 1
+        # batches are split per handler, take enough for the largest one
+        self._batch_size = max(self._batch_size, handler.batch_size)
+
+    def evict(self, predicate=None):
+        if self._queue is None:
+            return None
+        item = self._queue.evict(predicate)
+        if item is not None:
+            self._taken(item)
+        return item
 
 
 class FluentHandler(logging.Handler):
     """
     Logging Handler for fluent.
+
+    Records wait in a :class:`LogQueue` shared by the handlers of the event
+    loop, up to `queue_size` records of each handler, and are sent in batches
+    of up to `batch_size` records. When the handler has `queue_size` records
+    queued, `overflow_policy` decides what is discarded: `drop_newest` the
+    record being logged, `drop_oldest` its oldest queued record, `drop_level`
+    its oldest queued record below `overflow_level`, unless the new record is
+    below it as well. Discarded records are counted by level name in
+    `dropped`.
+
+    With `collapse_window` seconds, records repeated from the same call site
+    within the window are collapsed by a :class:`RepeatCollapser` into a
+    summary record with `repeat_count`, `repeat_first` and `repeat_last`.
     """
 
+    overflow_policies = OVERFLOW_POLICIES
+
     # class singletons
     _queue = None
     _queue_task = None
@@ -131,9 +381,24 @@ class FluentHandler(logging.Handler):
         verbose=False,
         loop=None,
         nanosecond_precision=False,
+        batch_size=MAX_BATCH_SIZE,
+        queue_size=MAX_QUEUE_SIZE,
+        overflow_policy="drop_newest",
+        overflow_level=logging.WARNING,
+        block_timeout=1.0,
+        rate_limits=None,
+        collapse_window=None,
         **kwargs,
     ):
+        if overflow_policy not in self.overflow_policies:
+            raise ValueError("Unsupported overflow_policy: {}".format(overflow_policy))
         self.loop = loop
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.overflow_level = overflow_level
+        self.block_timeout = block_timeout
+        self.dropped = collections.Counter()
         self.tag = tag
         self.nanosecond_precision = nanosecond_precision
         self.sender = sender.FluentSender(
@@ -145,48 +410,499 @@ class FluentHandler(logging.Handler):
             nanosecond_precision=self.nanosecond_precision,
             **kwargs,
         )
+        self.sender.metrics.gauge("queue_size", self.qsize)
+        # records shed by `rate_limits` rules are never queued nor formatted
+        self.limiter = None
+        if rate_limits:
+            self.limiter = RateLimiter(rate_limits, self.sender.metrics)
+        self.collapser = None
+        if collapse_window:
+            self.collapser = RepeatCollapser(collapse_window)
+        self._collapse_timer = None
+        self._closing = False
+        # records accepted and not handed to the sender yet, and records
+        # handed to it so far
+        self._unsent_records = 0
+        self._sent_records = 0
+        self._sent_event = None
         self.last_warning_sent = 0
         logging.Handler.__init__(self)
+        _queue_handlers.add(self)
+
+    def _allow(self, record):
+        return self.limiter.allow(
+            tag=self.tag, logger=record.name, level=record.levelno
+        )
 
     def emit(self, record):
+        if self._closing:
+            return
+        if self.collapser is not None and not self._collapse(record):
+            return
+        if self.limiter is not None and not self._allow(record):
+            return
+        self._enqueue(record)
+
+    def _collapse(self, record):
+        for summary in self.collapser.expired(record.created):
+            self._enqueue(summary)
+        if self.collapser.collapse(record):
+            return True
+        self.sender.metrics.incr("repeats_collapsed")
+        self._schedule_summaries()
+        return False
+
+    def _schedule_summaries(self):
+        # summaries are also sent when nothing is logged anymore
+        if self._collapse_timer is not None:
+            return
+        expiry = self.collapser.next_expiry()
+        if expiry is not None:
+            self._collapse_timer = self._call_later(
+                max(expiry - time.time(), 0), self._send_summaries
+            )
+
+    def _send_summaries(self):
+        self._collapse_timer = None
+        for summary in self.collapser.expired():
+            self._enqueue(summary)
+        self._schedule_summaries()
+
+    def _flush_summaries(self):
+        if self._collapse_timer is not None:
+            self._collapse_timer.cancel()
+            self._collapse_timer = None
+        if self.collapser is not None:
+            for summary in self.collapser.flush():
+                self._enqueue(summary)
+
+    def _call_later(self, delay, callback):
+        try:
+            loop = self.loop or asyncio.get_event_loop()
+            return loop.call_later(delay, callback)
+        except RuntimeError:
+            return None
+
+    def _enqueue(self, record):
         if FluentHandler._queue_task is None or FluentHandler._queue_task.done():
             # the queue should be a singleton, we don't need a task
             # for every log handler
             try:
-                FluentHandler._queue = LogQueue()
+                FluentHandler._queue = LogQueue(batch_size=self.batch_size)
                 FluentHandler._queue_task = asyncio.ensure_future(
                     FluentHandler._queue.consume_queue(record, self), loop=self.loop
                 )
+                self._unsent_records += 1
             except RuntimeError:
                 sys.stderr.write("No event loop running to send log to fluentd\n")
         else:
             try:
                 FluentHandler._queue.put_nowait((record, self, time.time()))
+                self._unsent_records += 1
             except RuntimeError:
                 sys.stderr.write("RuntimeError, likely event loop closing\n")
             except asyncio.QueueFull:
-                if time.time() - self.last_warning_sent > 30:
-                    sys.stderr.write(
-                        f"Fluentd hit max log queue size({MAX_QUEUE_SIZE}), "
-                        "discarding message\n"
-                    )
-                    self.last_warning_sent = time.time()
+                self._queue_full(record)
             except AttributeError:
                 sys.stderr.write("Error sending async fluentd message\n")
 
-    async def async_emit(self, record, timestamp=None):
+    def _sheddable(self, record):
+        return record.levelno < self.overflow_level
+
+    def _queue_full(self, record):
+        victim = None
+        if self.overflow_policy == "drop_oldest":
+            victim = FluentHandler._queue.evict(self._owns)
+        elif self.overflow_policy == "drop_level" and not self._sheddable(record):
+            victim = FluentHandler._queue.evict(
+                lambda item: self._owns(item) and self._sheddable(item[0])
+            )
+        if victim is None:
+            self._count_dropped(record)
+            return
+        victim_record, victim_handler = victim[:2]
+        victim_handler._count_dropped(victim_record)
+        FluentHandler._queue.put_nowait((record, self, time.time()))
+
+    def _records_sent(self, number):
+        self._unsent_records -= number
+        self._sent_records += number
+        if self._sent_event is not None:
+            self._sent_event.set()
+
+    async def _wait_for_sent(self):
+        if self._sent_event is None:
+            self._sent_event = asyncio.Event()
+        while self._unsent_records > 0:
+            self._sent_event.clear()
+            await self._sent_event.wait()
+
+    def _count_dropped(self, record):
+        self.dropped[record.levelname] += 1
+        self.sender.metrics.incr("queue_full_drops." + record.levelname)
+        self._warn_queue_full()
+
+    def qsize(self):
+        """Number of records of this handler waiting to be sent"""
+        if FluentHandler._queue is None:
+            return 0
+        return FluentHandler._queue.qsize(self)
+
+    def _warn_queue_full(self):
+        if time.time() - self.last_warning_sent > 30:
+            sys.stderr.write(
+                f"Fluentd hit max log queue size({self.queue_size}), "
+                f"discarding messages, dropped so far: {dict(self.dropped)}\n"
+            )
+            self.last_warning_sent = time.time()
+
+    def _format(self, record):
         data = self.format(record)
+        if isinstance(data, dict) and hasattr(record, "repeat_count"):
+            data["repeat_count"] = record.repeat_count
+            data["repeat_first"] = record.repeat_first
+            data["repeat_last"] = record.repeat_last
+        return data
+
+    async def async_emit(self, record, timestamp=None):
+        data = self._format(record)
         return await self.sender.async_emit(None, data, timestamp)
 
+    async def async_emit_batch(self, records):
+        """Format `(record, timestamp)` pairs and send them together"""
+        events = []
+        for record, timestamp in records:
+            try:
+                events.append((timestamp, self._format(record)))
+            except:  # noqa
+                sys.stderr.write(
+                    "Error processing log\n{}\n".format(traceback.format_exc())
+                )
+        return await self.sender.async_emit_batch(None, events)
+
+    async def aclose(self, timeout=None):
+        """Refuse new records, send the queued ones and close.
+
+        Records still queued after `timeout` seconds, the sender's `timeout`
+        by default, are dropped, and the sender gets the time left to send
+        its buffers, see :meth:`FluentSender.aclose`. Returns its report with
+        the numbers of `flushed_records` and `dropped_records`.
+        """
+        timeout = self.sender._timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        sent = self._sent_records
+        written = self.sender.metrics.counters["bytes_written"]
+        self._flush_summaries()
+        self._closing = True
+        # queued records, and those the consumer is sending already
+        try:
+            await asyncio.wait_for(self._wait_for_sent(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        dropped = 0
+        if FluentHandler._queue is not None:
+            while FluentHandler._queue.evict(self._owns) is not None:
+                self._unsent_records -= 1
+                dropped += 1
+        report = await self.sender.aclose(max(deadline - time.monotonic(), 0))
+        self.close()
+        report["flushed_bytes"] = (
+            self.sender.metrics.counters["bytes_written"] - written
+        )
+        report["flushed_records"] = self._sent_records - sent
+        # and the records still being sent when the sender closed
+        report["dropped_records"] = dropped + self._unsent_records
+        return report
+
+    def _owns(self, item):
+        return item[1] is self
+
     def close(self):
         self.acquire()
         try:
+            self._flush_summaries()
             self.sender.close()
             logging.Handler.close(self)
-            if self._queue_task is not None and not self._queue_task.done():
+            _queue_handlers.discard(self)
+            # the consumer is shared, it stops once no open handler uses it
+            task = self._queue_task
+            if not _queue_handlers and task is not None and not task.done():
+                try:
+                    task.cancel()
+                except RuntimeError:
+                    pass
+        finally:
+            self.release()
+
+
+class _ThreadsafeTimer(object):
+    """Timer on `loop` scheduled and cancelled from any thread"""
+
+    def __init__(self, loop, delay, callback):
+        self._loop = loop
+        self._callback = callback
+        self._handle = None
+        self._cancelled = False
+        loop.call_soon_threadsafe(self._schedule, delay)
+
+    def _schedule(self, delay):
+        if not self._cancelled:
+            self._handle = self._loop.call_later(delay, self._run)
+
+    def _run(self):
+        # cancelled while the timer was already due
+        if not self._cancelled:
+            self._callback()
+
+    def cancel(self):
+        self._cancelled = True
+        handle = self._handle
+        if handle is not None:
+            try:
+                self._loop.call_soon_threadsafe(handle.cancel)
+            except RuntimeError:
+                # event loop already closed
+                pass
+
+
+class ThreadedFluentHandler(FluentHandler):
+    """
+    Logging Handler for fluent sending from its own thread and event loop.
+
+    Records can be logged from any thread, whether an event loop is running
+    there or not. They are handed to the I/O thread through a deque, the
+    I/O thread is only woken up when it is idle.
+
+    Besides the policies of :class:`FluentHandler`, `overflow_policy` can be
+    `block` to make the logging thread wait up to `block_timeout` seconds for
+    room in the queue before the record is discarded.
+    """
+
+    overflow_policies = OVERFLOW_POLICIES + ("block",)
+
+    def __init__(self, tag, **kwargs):
+        super(ThreadedFluentHandler, self).__init__(tag, **kwargs)
+        # records go through its own deque, not the shared log queue
+        _queue_handlers.discard(self)
+        self._after_fork()
+        _threaded_handlers.add(self)
+
+    def _after_fork(self):
+        # the I/O thread does not survive a fork, the next record starts a new
+        # one, and what the parent queued is sent by the parent
+        self._records = collections.deque()
+        self._not_full = threading.Condition()
+        self._blocked = 0
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._io_loop = None
+        self._wakeup = None
+        self._waiting = False
+        # records of the batch the I/O thread is sending
+        self._sending = 0
+        # set by `aclose`, when the I/O thread stops sending records
+        self._deadline = None
+        self._report = None
+
+    def _start(self):
+        with self._thread_lock:
+            if self._thread is not None:
+                return
+            self._io_loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=self._run, name="aiofluent-{}".format(self.tag), daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self._io_loop)
+        try:
+            self._io_loop.run_until_complete(self._consume())
+        finally:
+            self._io_loop.close()
+
+    async def _consume(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            while self._records and not self._past_deadline():
+                batch = []
+                while self._records and len(batch) < self.batch_size:
+                    batch.append(self._records.popleft())
+                if self._blocked:
+                    with self._not_full:
+                        self._not_full.notify_all()
+                self._sending = len(batch)
                 try:
-                    self._queue_task.cancel()
+                    await self.async_emit_batch(batch)
+                except:  # noqa
+                    sys.stderr.write(
+                        "Error processing log\n{}\n".format(traceback.format_exc())
+                    )
+                finally:
+                    self._sending = 0
+                    self._sent_records += len(batch)
+            if self._closing:
+                break
+            # announce we are waiting before looking at the deque again, so
+            # a record appended in between always wakes us up
+            self._wakeup.clear()
+            self._waiting = True
+            if self._records:
+                self._waiting = False
+                continue
+            await self._wakeup.wait()
+        if self._deadline is None:
+            self.sender.close()
+            # let the tasks of the sender see their cancellation
+            await asyncio.sleep(0)
+            return
+        dropped = len(self._records)
+        self._records.clear()
+        self._report = await self.sender.aclose(
+            max(self._deadline - time.monotonic(), 0)
+        )
+        self._report["dropped_records"] = dropped
+
+    def _past_deadline(self):
+        return self._deadline is not None and time.monotonic() >= self._deadline
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _call_later(self, delay, callback):
+        try:
+            return _ThreadsafeTimer(self._io_loop, delay, callback)
+        except (AttributeError, RuntimeError):
+            # not started, or closing
+            return None
+
+    def _enqueue(self, record):
+        if self._thread is None:
+            self._start()
+        if self._closing:
+            return
+        if len(self._records) >= self.queue_size and not self._make_room(record):
+            return
+        self._records.append((record, time.time()))
+        if self._waiting:
+            self._waiting = False
+            try:
+                self._io_loop.call_soon_threadsafe(self._wake)
+            except RuntimeError:
+                sys.stderr.write("RuntimeError, likely event loop closing\n")
+
+    def _has_room(self):
+        return len(self._records) < self.queue_size
+
+    def _make_room(self, record):
+        """Apply the overflow policy, returns whether `record` can be queued"""
+        if self.overflow_policy == "block":
+            # the I/O thread logging on its own would wait for itself
+            if threading.current_thread() is not self._thread:
+                with self._not_full:
+                    self._blocked += 1
+                    try:
+                        if self._not_full.wait_for(self._has_room, self.block_timeout):
+                            return True
+                    finally:
+                        self._blocked -= 1
+            self._count_dropped(record)
+            return False
+
+        victim = None
+        if self.overflow_policy == "drop_oldest":
+            try:
+                victim = self._records.popleft()
+            except IndexError:
+                # consumed in the meantime
+                return True
+        elif self.overflow_policy == "drop_level" and not self._sheddable(record):
+            for item in list(self._records):
+                if self._sheddable(item[0]):
+                    try:
+                        self._records.remove(item)
+                    except ValueError:
+                        # consumed in the meantime
+                        return True
+                    victim = item
+                    break
+        if victim is None:
+            self._count_dropped(record)
+            return False
+        self._count_dropped(victim[0])
+        return True
+
+    def qsize(self):
+        return len(self._records)
+
+    async def aclose(self, timeout=None):
+        """Refuse new records, send the queued ones and close.
+
+        The I/O thread sends records for up to `timeout` seconds, the
+        sender's `timeout` by default, drops the others and gives the sender
+        the time left, see :meth:`FluentHandler.aclose`.
+        """
+        timeout = self.sender._timeout if timeout is None else timeout
+        if self._thread is None or not self._thread.is_alive():
+            report = await self.sender.aclose(timeout)
+            self.close()
+            report["flushed_records"] = report["dropped_records"] = 0
+            return report
+
+        sent = self._sent_records
+        written = self.sender.metrics.counters["bytes_written"]
+        self._flush_summaries()
+        self._deadline = time.monotonic() + timeout
+        self._closing = True
+        try:
+            self._io_loop.call_soon_threadsafe(self._wake)
+        except RuntimeError:
+            pass
+        # a send started before the deadline may take up to the sender timeout
+        await asyncio.get_event_loop().run_in_executor(
+            None, self._thread.join, timeout + self.sender._timeout
+        )
+        self.close()
+        report = self._report
+        if report is None:
+            # the I/O thread is still stuck sending
+            report = dict.fromkeys(("spilled_bytes", "dropped_bytes"), 0)
+            report["dropped_records"] = len(self._records) + self._sending
+        report["flushed_bytes"] = (
+            self.sender.metrics.counters["bytes_written"] - written
+        )
+        report["flushed_records"] = self._sent_records - sent
+        return report
+
+    def close(self):
+        self.acquire()
+        try:
+            if self._thread is not None and self._thread.is_alive():
+                self._flush_summaries()
+                self._closing = True
+                try:
+                    self._io_loop.call_soon_threadsafe(self._wake)
                 except RuntimeError:
                     pass
+                self._thread.join(self.sender._timeout)
+            elif self._thread is None:
+                self.sender.close()
+            logging.Handler.close(self)
         finally:
             self.release()
+
+
+def _after_fork_in_child():
+    # the queue consumer task belongs to the event loop of the parent
+    FluentHandler._queue = None
+    FluentHandler._queue_task = None
+    for handler in list(_queue_handlers):
+        # the parent sends what it queued
+        handler._unsent_records = 0
+    for handler in list(_threaded_handlers):
+        handler._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
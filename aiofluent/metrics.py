@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Counters, gauges and histograms describing what a sender is doing."""
+
+import bisect
+import collections
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Histogram(object):
+    """Counts of observed values per bucket, with their count and sum"""
+
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        # the last bucket holds values over every bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        buckets = {str(bound): count for bound, count in zip(self.bounds, self.counts)}
+        buckets["+Inf"] = self.counts[-1]
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class Metrics(object):
+    """Metrics of a :class:`FluentSender` and the handlers using it.
+
+    Counters and histograms are updated as events go through, gauges are
+    functions called when a snapshot is taken.
+    """
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.histograms = {}
+        self._gauges = {}
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, func):
+        """Report the value returned by `func` as `name`"""
+        self._gauges[name] = func
+
+    def snapshot(self):
+        return {
+            "counters": dict(self.counters),
+            "gauges": {name: func() for name, func in self._gauges.items()},
+            "histograms": {
+                name: histogram.snapshot()
+                for name, histogram in self.histograms.items()
+            },
+        }
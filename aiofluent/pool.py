@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from aiofluent.sender import UNIX_SCHEME, FluentSender
+
+STRATEGIES = ("round_robin", "least_pending", "tag_hash")
+SHARD_BY = {"tag": "tag_hash", "round_robin": "round_robin"}
+
+
+def _parse_endpoint(endpoint):
+    """Endpoints are `"host:port"` strings or `(host, port[, weight])` tuples"""
+    if isinstance(endpoint, str) and endpoint.startswith(UNIX_SCHEME):
+        return endpoint, None, 1
+    if isinstance(endpoint, str):
+        host, _, port = endpoint.rpartition(":")
+        return host, int(port), 1
+    if len(endpoint) == 2:
+        return endpoint[0], endpoint[1], 1
+    return tuple(endpoint)
+
+
+class FluentSenderPool(object):
+    """Spread events over several fluentd endpoints.
+
+    Every endpoint gets its own :class:`FluentSender`, built with the same
+    extra keyword arguments. Endpoints that recently failed are skipped, and
+    the backlog of a failing endpoint is moved to a healthy one.
+
+    :param endpoints: list of `"host:port"` or `(host, port[, weight])`.
+    :param strategy: `round_robin`, weighted by the endpoint weights,
+      `least_pending` to pick the endpoint with the smallest backlog, or
+      `tag_hash` to always use the same endpoint for a label.
+    """
+
+    def __init__(self, tag, endpoints, strategy="round_robin", **kwargs):
+        if strategy not in STRATEGIES:
+            raise ValueError("Unsupported strategy: {}".format(strategy))
+        if not endpoints:
+            raise ValueError("At least one endpoint is required")
+
+        self._tag = tag
+        self._strategy = strategy
+        self.senders = []
+        self._weights = []
+        for endpoint in endpoints:
+            host, port, weight = _parse_endpoint(endpoint)
+            self.senders.append(FluentSender(tag, host=host, port=port, **kwargs))
+            self._weights.append(weight)
+        self._current_weights = [0] * len(self.senders)
+
+    def select(self, label=None):
+        """Sender to use for the next event"""
+        if self._strategy == "tag_hash":
+            # keeps the events of a label in order, unless its sender fails
+            start = hash(label) % len(self.senders)
+            for offset in range(len(self.senders)):
+                sender = self.senders[(start + offset) % len(self.senders)]
+                if sender.healthy:
+                    return sender
+            return self.senders[start]
+
+        candidates = [
+            idx for idx, sender in enumerate(self.senders) if sender.healthy
+        ] or list(range(len(self.senders)))
+
+        if self._strategy == "least_pending":
+            return min(
+                (self.senders[idx] for idx in candidates),
+                key=lambda sender: sender.pending_size,
+            )
+
+        # smooth weighted round robin
+        total = 0
+        best = None
+        for idx in candidates:
+            self._current_weights[idx] += self._weights[idx]
+            total += self._weights[idx]
+            if best is None or self._current_weights[idx] > self._current_weights[best]:
+                best = idx
+        self._current_weights[best] -= total
+        return self.senders[best]
+
+    async def _failover(self):
+        """Move the backlog of unhealthy senders to a healthy one.
+
+        Returns `None` when there was nothing to move, otherwise whether the
+        backlog was sent.
+        """
+        result = None
+        for sender in self.senders:
+            if sender.healthy or not sender.pending_size:
+                continue
+            target = self.select()
+            if not target.healthy:
+                # nowhere to go, everything is down
+                return False
+            target._pendings.extend(sender._pendings.take())
+            # frames waiting for an ack keep their chunk, the target sends
+            # them as its window allows
+            accepted = True
+            for chunk, frame in sender._take_unacked():
+                if not target._add_waiting(chunk, frame):
+                    accepted = False
+            sent = bool(await target._async_send([])) and accepted
+            result = sent and result is not False
+        return result
+
+    async def _async_check_failover(self, result):
+        # also catches failures of background flushes in non-blocking mode
+        moved = await self._failover()
+        if result is False and moved is not None:
+            return moved
+        return result
+
+    async def async_emit(self, label, data, timestamp=None):
+        result = await self.select(label).async_emit(label, data, timestamp)
+        return await self._async_check_failover(result)
+
+    async def async_emit_with_time(self, label, timestamp, data):
+        result = await self.select(label).async_emit_with_time(label, timestamp, data)
+        return await self._async_check_failover(result)
+
+    async def flush(self):
+        result = True
+        for sender in self.senders:
+            if not await sender.flush():
+                result = False
+        return result
+
+    @property
+    def last_error(self):
+        errors = [s.last_error for s in self.senders if s.last_error is not None]
+        return errors[-1] if errors else None
+
+    def clear_last_error(self):
+        for sender in self.senders:
+            sender.clear_last_error()
+
+    def close(self):
+        for sender in self.senders:
+            sender.close()
+
+
+class ShardedFluentSender(FluentSenderPool):
+    """Several connections to a single fluentd endpoint.
+
+    Each connection is a :class:`FluentSender` with its own buffer and
+    reconnect state, so a stalled socket only holds up its own share.
+
+    :param connections: number of connections to open.
+    :param shard_by: `tag` to keep the events of a label on one connection,
+      in order, or `round_robin`.
+    """
+
+    def __init__(
+        self,
+        tag,
+        host="localhost",
+        port=24224,
+        connections=4,
+        shard_by="tag",
+        **kwargs,
+    ):
+        if shard_by not in SHARD_BY:
+            raise ValueError("Unsupported shard_by: {}".format(shard_by))
+        super(ShardedFluentSender, self).__init__(
+            tag,
+            [(host, port)] * connections,
+            strategy=SHARD_BY[shard_by],
+            **kwargs,
+        )
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Rate limits and sampling applied before events are formatted or packed."""
+
+import collections
+import fnmatch
+import logging
+import random
+import time
+
+
+class Rule(object):
+    """Shed the matching events over `rate` per second, or out of `sample`.
+
+    Unset criteria match everything. `tag` and `label` are glob patterns,
+    `logger` also matches its child loggers and `level` is a level name or
+    number matched exactly. The rate limit is a token bucket holding up to
+    `burst` events, shared by every event the rule matches.
+
+    :param rate: events per second let through, `None` for no limit.
+    :param burst: events let through at once, `rate` by default.
+    :param sample: fraction of the events kept, e.g. `0.1` for one in ten.
+    """
+
+    def __init__(
+        self,
+        tag=None,
+        label=None,
+        logger=None,
+        level=None,
+        rate=None,
+        burst=None,
+        sample=None,
+        name=None,
+    ):
+        if isinstance(level, str):
+            level = logging.getLevelName(level)
+        self.tag = tag
+        self.label = label
+        self.logger = logger
+        self.level = level
+        self.rate = rate
+        self.burst = max(burst or rate or 1, 1)
+        self.sample = sample
+        self.name = name or ",".join(
+            "{}={}".format(key, value)
+            for key, value in (
+                ("tag", tag),
+                ("label", label),
+                ("logger", logger),
+                ("level", level),
+            )
+            if value is not None
+        )
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def matches(self, tag, label, logger, level):
+        if self.tag is not None and not fnmatch.fnmatchcase(tag or "", self.tag):
+            return False
+        if self.label is not None and not fnmatch.fnmatchcase(label or "", self.label):
+            return False
+        if self.logger is not None and not self._matches_logger(logger):
+            return False
+        if self.level is not None and level != self.level:
+            return False
+        return True
+
+    def _matches_logger(self, logger):
+        if logger is None:
+            return False
+        return logger == self.logger or logger.startswith(self.logger + ".")
+
+    def _take_token(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def check(self):
+        """`None` when a matching event is kept, otherwise why it is shed"""
+        if self.sample is not None and random.random() >= self.sample:
+            return "sampled_out"
+        if self.rate is not None and not self._take_token():
+            return "rate_limited"
+        return None
+
+
+class RateLimiter(object):
+    """First matching rule decides whether an event goes through.
+
+    Shed events are counted per rule name in `dropped`, and as
+    `sampled_out` or `rate_limited` in `metrics` when given.
+    """
+
+    def __init__(self, rules, metrics=None):
+        self.rules = list(rules)
+        self.metrics = metrics
+        self.dropped = collections.Counter()
+
+    def allow(self, tag=None, label=None, logger=None, level=None):
+        for rule in self.rules:
+            if not rule.matches(tag, label, logger, level):
+                continue
+            reason = rule.check()
+            if reason is None:
+                return True
+            self.dropped[rule.name] += 1
+            if self.metrics is not None:
+                self.metrics.incr(reason)
+            return False
+        return True
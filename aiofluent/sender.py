@@ -1,14 +1,38 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import base64
+import collections
+import functools
+import gzip
+import os
+import random
 import socket
 import struct
 import sys
 import time
 import traceback
+import uuid
+import weakref
 
 import msgpack
 
+from aiofluent.metrics import Metrics
+from aiofluent.ratelimit import RateLimiter
+from aiofluent.spill import SpillBuffer
+
 _global_sender = None
+# every sender of the process, reset in the child after a fork
+_senders = weakref.WeakSet()
+
+# `host` prefix to connect to a unix domain socket, e.g. `unix:///var/run/fluent.sock`
+UNIX_SCHEME = "unix://"
+COMPRESSIONS = ("gzip",)
+GZIP_COMPRESS_LEVEL = 6
+
+# msgpack fixarray headers
+_ARRAY2 = b"\x92"
+_ARRAY3 = b"\x93"
+_ARRAY4 = b"\x94"
 
 
 def _set_global_sender(sender):
@@ -30,30 +54,166 @@ def close():
     get_global_sender().close()
 
 
+def _after_fork_in_child():
+    for sender in list(_senders):
+        sender._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
 async def connection_factory(sender):
+    if sender._host.startswith(UNIX_SCHEME):
+        _, _, path = sender._host.partition(UNIX_SCHEME)
+        connect = asyncio.open_unix_connection(path)
+    else:
+        connect = asyncio.open_connection(sender._host, sender._port)
     try:
-        return await asyncio.wait_for(
-            asyncio.open_connection(sender._host, sender._port), sender._timeout
-        )
+        reader, writer = await asyncio.wait_for(connect, sender._timeout)
     except (asyncio.TimeoutError, asyncio.CancelledError) as ex:
         sys.stderr.write("Timeout connecting to fluentd")
         sender.last_error = ex
     except Exception as ex:
         sys.stderr.write("Unknown error connecting to fluentd")
         sender.last_error = ex
+    else:
+        if sender._keepalive is not None:
+            _set_keepalive(writer.get_extra_info("socket"), sender._keepalive)
+        return reader, writer
+
+
+def _set_keepalive(sock, idle):
+    """Probe the peer after `idle` seconds without traffic"""
+    if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # a dead peer is noticed after `idle` seconds and 3 more probes
+    for option, value in (
+        ("TCP_KEEPIDLE", idle),
+        ("TCP_KEEPINTVL", idle),
+        ("TCP_KEEPCNT", 3),
+    ):
+        if hasattr(socket, option):
+            sock.setsockopt(
+                socket.IPPROTO_TCP, getattr(socket, option), max(int(value), 1)
+            )
+
+
+def _map_header(size):
+    if size < 0x10:
+        return struct.pack(">B", 0x80 | size)
+    if size < 0x10000:
+        return struct.pack(">BH", 0xDE, size)
+    return struct.pack(">BI", 0xDF, size)
+
+
+def _bin_header(size):
+    if size < 0x100:
+        return struct.pack(">BB", 0xC4, size)
+    if size < 0x10000:
+        return struct.pack(">BH", 0xC5, size)
+    return struct.pack(">BI", 0xC6, size)
+
+
+_EVENT_TIME_DATA = struct.Struct(">II")
+# EventTime as msgpack fixext8 with type 0, header included
+_EVENT_TIME_EXT = struct.Struct(">BBII")
+
+
+def _pack_event_time(timestamp):
+    """Packed EventTime of a float `timestamp`"""
+    return _EVENT_TIME_EXT.pack(0xD7, 0, int(timestamp), int(timestamp % 1 * 10**9))
+
+
+def _pack_event_time_ns(timestamp_ns):
+    """Packed EventTime of an integer timestamp in nanoseconds"""
+    seconds, nanoseconds = divmod(timestamp_ns, 1000000000)
+    return _EVENT_TIME_EXT.pack(0xD7, 0, seconds, nanoseconds)
 
 
 class EventTime(msgpack.ExtType):
     def __new__(cls, timestamp):
         seconds = int(timestamp)
-        nanoseconds = int(timestamp % 1 * 10 ** 9)
+        nanoseconds = int(timestamp % 1 * 10**9)
         return super(EventTime, cls).__new__(
             cls,
             code=0,
-            data=struct.pack(">II", seconds, nanoseconds),
+            data=_EVENT_TIME_DATA.pack(seconds, nanoseconds),
         )
 
 
+def _cancel_task(task):
+    if task is not None and not task.done():
+        try:
+            task.cancel()
+        except RuntimeError:
+            # event loop already closed
+            pass
+
+
+class _Batch(object):
+    """Entries of a single tag waiting to be sent as one PackedForward frame"""
+
+    __slots__ = ("entries", "size", "started")
+
+    def __init__(self):
+        self.entries = bytearray()
+        self.size = 0
+        # when the oldest entry was added
+        self.started = time.monotonic()
+
+    def append(self, entry):
+        self.entries += entry
+        self.size += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class _PendingBuffer(object):
+    """Packets waiting for a connection, kept as a list of chunks.
+
+    Appending never copies what is already buffered, and the chunks are
+    written with a single `writelines` call once connected.
+    """
+
+    __slots__ = ("chunks", "size")
+
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.size = 0
+
+    def append(self, chunk):
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+
+    def extend(self, chunks):
+        for chunk in chunks:
+            self.append(chunk)
+
+    def restore(self, chunks):
+        """Put back `chunks` taken out earlier, ahead of anything newer"""
+        for chunk in reversed(chunks):
+            self.chunks.appendleft(chunk)
+            self.size += len(chunk)
+
+    def take(self):
+        chunks = list(self.chunks)
+        self.clear()
+        return chunks
+
+    def getvalue(self):
+        return b"".join(self.chunks)
+
+    def clear(self):
+        self.chunks.clear()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+
 class FluentSender(object):
     def __init__(
         self,
@@ -65,10 +225,31 @@ class FluentSender(object):
         verbose=False,
         buffer_overflow_handler=None,
         retry_timeout=30,
+        reconnect_delay=0.1,
+        keepalive=None,
         connection_factory=connection_factory,
         nanosecond_precision=True,
+        packed_forward=False,
+        max_batch_size=64 * 1024,
+        flush_interval=1.0,
+        compressed=None,
+        compress_threshold=32 * 1024,
+        require_ack=False,
+        ack_window=16,
+        ack_timeout=None,
+        nonblocking=False,
+        tag_cache_size=256,
+        spill_dir=None,
+        spill_max_size=256 * 1024 * 1024,
+        static_fields=None,
+        metrics_interval=None,
+        metrics_label="aiofluent.metrics",
+        metrics_callback=None,
+        rate_limits=None,
         **kwargs
     ):
+        if compressed is not None and compressed not in COMPRESSIONS:
+            raise ValueError("Unsupported compression: {}".format(compressed))
 
         self._tag = tag
         self._host = host
@@ -79,96 +260,704 @@ class FluentSender(object):
         self._buffer_overflow_handler = buffer_overflow_handler
         self._nanosecond_precision = nanosecond_precision
 
-        self._pendings = None
+        self._pendings = _PendingBuffer()
+        # chunk lists written to the connection and not drained yet, oldest
+        # first, put back in this order if the connection is lost
+        self._writing = collections.deque()
         self._reader = None
         self._writer = None
+
+        # after a failed connection attempt or a lost connection, connecting
+        # is on hold for `reconnect_delay`, doubled up to `retry_timeout` with
+        # every failed attempt, and a background task reconnects
         self._retry_timeout = retry_timeout
+        self._reconnect_delay = reconnect_delay
+        self._reconnect_attempts = 0
+        self._reconnect_at = 0
+        self._connect_task = None
+        self._attempt = None
+        # seconds idle before TCP keepalive probes, `None` to not send them
+        self._keepalive = keepalive
 
         self._last_error = None
-        self._last_error_time = 0
-        self._lock = None
 
         self._connection_factory = connection_factory
 
+        # overflowed data goes to disk instead of being dropped, forked
+        # children spill to a directory of their own in `spill_dir`
+        self._spill_dir = spill_dir
+        self._spill = None
+        if spill_dir is not None:
+            self._spill = SpillBuffer(spill_dir, max_size=spill_max_size)
+        self._spill_task = None
+
+        # a single Packer is reused for every event, and the packed tag of
+        # the most used labels is kept around
+        self._packer = msgpack.Packer()
+        self._packed_tag = functools.lru_cache(maxsize=tag_cache_size)(self._pack_tag)
+
+        # fields added to every dict record, packed once as map pairs and
+        # spliced in front of the record's own pairs
+        self._static_fields = None
+        self._static_count = 0
+        if static_fields:
+            self._static_fields = b"".join(
+                self._packer.pack(key) + self._packer.pack(value)
+                for key, value in static_fields.items()
+            )
+            self._static_count = len(static_fields)
+
+        # PackedForward mode: entries are grouped per tag and sent as
+        # `[tag, entries, option]` frames
+        self._packed_forward = packed_forward or compressed is not None
+        self._max_batch_size = max_batch_size
+        self._flush_interval = flush_interval
+        self._batches = {}
+        self._flush_task = None
+        self._flush_event = None
+
+        # Non-blocking mode: emits only serialize and buffer, the flush task
+        # is the only one writing to (and connecting) the socket
+        self._nonblocking = nonblocking
+        self._buffer = []
+        # bytes serialized but not handed to the connection yet
+        self._buffered = 0
+
+        # CompressedPackedForward mode: batches over `compress_threshold`
+        # bytes are compressed in an executor, off the event loop
+        self._compressed = compressed
+        self._compress_threshold = compress_threshold
+        self._compress_lock = None
+
+        # At-least-once delivery: every frame carries a `chunk` option and is
+        # kept until fluentd acks it, with at most `ack_window` frames in flight
+        self._require_ack = require_ack
+        self._ack_window = ack_window
+        self._ack_timeout = timeout if ack_timeout is None else ack_timeout
+        self._inflight = collections.OrderedDict()
+        self._resend_inflight = False
+        # chunks of the frames in flight written to the current connection
+        self._sent_chunks = set()
+        # frames that did not fit in the window, or came while disconnected,
+        # wait here in order, up to `bufmax` bytes
+        self._waiting = collections.OrderedDict()
+        self._waiting_size = 0
+        self._ack_task = None
+        self._ack_event = None
+
+        # every `metrics_interval` seconds a snapshot is passed to
+        # `metrics_callback` and emitted as an event on `metrics_label`
+        self.metrics = Metrics()
+        self.metrics.gauge("pending_size", lambda: self.pending_size)
+        self.metrics.gauge("inflight", lambda: len(self._inflight))
+        self._metrics_interval = metrics_interval
+        self._metrics_label = metrics_label
+        self._metrics_callback = metrics_callback
+        self._metrics_task = None
+        self._connected = False
+        # events shed by `rate_limits` rules are never packed
+        self._limiter = None
+        if rate_limits:
+            self._limiter = RateLimiter(rate_limits, self.metrics)
+        # when the oldest event of the non-blocking buffer was emitted
+        self._buffer_started = None
+        # set by `aclose`, emits are refused while the buffers drain
+        self._closing = False
+
+        _senders.add(self)
+
+    @property
+    def flush_event(self):
+        if self._flush_event is None:
+            self._flush_event = asyncio.Event()
+        return self._flush_event
+
     @property
-    def lock(self):
-        if self._lock is None:
-            self._lock = asyncio.Lock()
-        return self._lock
+    def ack_event(self):
+        if self._ack_event is None:
+            self._ack_event = asyncio.Event()
+        return self._ack_event
+
+    @property
+    def compress_lock(self):
+        if self._compress_lock is None:
+            self._compress_lock = asyncio.Lock()
+        return self._compress_lock
 
     async def get_writer(self):
-        async with self.lock:
-            if self._writer is not None:
-                return self._writer
+        """The connection, `None` while reconnecting in the background.
+
+        Until the first connection is made, callers share the connection
+        attempt in progress, unless connecting is on hold after an error.
+        Afterwards they never wait, the reconnect task sends what they
+        buffered once connected again.
+        """
+        writer = self._writer
+        if writer is not None:
+            return writer
+        if not self._connected and self.healthy:
+            await asyncio.shield(self._ensure_attempt())
+        if self._writer is None:
+            self._ensure_connect_task()
+        return self._writer
+
+    async def connect(self):
+        """Connect now, also while on hold, returns whether connected"""
+        if self._writer is None:
+            await asyncio.shield(self._ensure_attempt())
+        return self._writer is not None
 
-            if (self._last_error_time + self._retry_timeout) > time.time():
-                return
+    def _ensure_attempt(self):
+        if self._attempt is None or self._attempt.done():
+            self._attempt = asyncio.ensure_future(self._connect_once())
+        return self._attempt
 
+    async def _connect_once(self):
+        try:
             result = await self._connection_factory(self)
-            if result:
-                self._reader, self._writer = result
-            return self._writer
+        except Exception as ex:
+            self.last_error = ex
+            result = None
+        if not result:
+            self.metrics.incr("connect_failures")
+            self._backoff()
+            return False
+        self._set_connection(*result)
+        return True
+
+    def _ensure_connect_task(self):
+        if self._connect_task is None or self._connect_task.done():
+            self._connect_task = asyncio.ensure_future(self._connect_loop())
+
+    async def _connect_loop(self):
+        task = asyncio.current_task()
+        while self._reconnecting(task):
+            delay = self._reconnect_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await asyncio.shield(self._ensure_attempt())
+        if self._writer is not None and self._connect_task is task:
+            await self._send_backlog()
+
+    def _reconnecting(self, task):
+        # stop once `close` dropped the task, idle senders connect with the
+        # next event
+        if self._writer is not None or self._connect_task is not task:
+            return False
+        return self._has_unsent() or bool(self._spill)
+
+    def _set_connection(self, reader, writer):
+        self._reader, self._writer = reader, writer
+        self._reconnect_attempts = 0
+        self._reconnect_at = 0
+        if self._connected:
+            self.metrics.incr("reconnects")
+        self._connected = True
+        self._sent_chunks.clear()
+        self._start_reader()
+        self._send_waiting()
+
+    def _backoff(self):
+        """Put connecting on hold, exponentially longer on every failure"""
+        delay = min(
+            self._reconnect_delay * 2**self._reconnect_attempts, self._retry_timeout
+        )
+        self._reconnect_attempts += 1
+        # half of the delay is random, senders of restarted processes do not
+        # all reconnect at once
+        self._reconnect_at = time.monotonic() + delay / 2 + random.uniform(0, delay / 2)
+
+    async def _send_backlog(self):
+        """Send what waited for the connection"""
+        if self._resend_inflight:
+            await self._async_resend_inflight()
+        if self._pendings and self._writer is not None:
+            await self._async_send_internal([])
+        if self._spill is not None and self._spill.refresh():
+            self._ensure_spill_task()
+
+    def _connection_lost(self):
+        # concurrent sends failing on the same connection keep their order
+        chunks = [chunk for written in self._writing for chunk in written]
+        self._writing.clear()
+        self.clean(chunks)
+        self._close_connection()
+        self._backoff()
+        # the backlog is sent as soon as the connection is back
+        self._ensure_connect_task()
+
+    @property
+    def healthy(self):
+        """False while connecting is on hold after an error"""
+        if self._writer is not None:
+            return True
+        return self._reconnect_at <= time.monotonic()
+
+    @property
+    def pending_size(self):
+        """Bytes waiting to be written, or for their ack"""
+        inflight = sum(len(frame) for frame in self._inflight.values())
+        return len(self._pendings) + self._buffered + self._waiting_size + inflight
 
     async def async_emit(self, label, data, timestamp=None):
-        if timestamp is not None:
-            ev_time = timestamp
-        elif self._nanosecond_precision:
-            ev_time = EventTime(time.time())
-        else:
-            ev_time = int(time.time())
-        return await self.async_emit_with_time(label, ev_time, data)
+        if self._limiter is not None and not self._allow(label):
+            return True
+        return await self._async_emit_packed(label, self._pack_time(timestamp), data)
 
     async def async_emit_with_time(self, label, timestamp, data):
+        if self._limiter is not None and not self._allow(label):
+            return True
+        return await self._async_emit_packed(label, self._pack_time(timestamp), data)
+
+    def _allow(self, label):
+        return self._limiter.allow(tag=self._make_tag(label), label=label)
+
+    async def async_emit_batch(self, label, events):
+        """Send `(timestamp, data)` pairs of a label together.
+
+        Unless the sender already batches, several events are sent right
+        away as a single PackedForward frame.
+        """
+        if self._closing:
+            return False
+        events = list(events)
+        if self._limiter is not None:
+            events = [event for event in events if self._allow(label)]
+        if self._metrics_interval is not None and self._metrics_task is None:
+            self._ensure_metrics_task()
+        if self._packed_forward or len(events) == 1:
+            result = True
+            for timestamp, data in events:
+                packed_time = self._pack_time(timestamp)
+                if not await self._async_emit_packed(label, packed_time, data):
+                    result = False
+            return result
+
+        batch = _Batch()
+        for timestamp, data in events:
+            packed_time = self._pack_time(timestamp)
+            try:
+                batch.append(self._make_entry(packed_time, data))
+            except Exception as e:
+                self.last_error = e
+                batch.append(self._make_entry(packed_time, self._error_record()))
+        if not batch:
+            return True
+        self.metrics.incr("events", batch.size)
+        if self._nonblocking:
+            option = self._make_option({"size": batch.size})
+            bytes_ = self._make_frame(label, batch.entries, option)
+            if self._buffered >= self._bufmax:
+                self._handle_overflow(bytes_)
+                return False
+            self._add_to_buffer(bytes_, option)
+            return True
+        return await self._async_send_batch(label, batch)
+
+    def _pack_time(self, timestamp=None):
+        if timestamp is None:
+            if self._nanosecond_precision:
+                return _pack_event_time_ns(time.time_ns())
+            return self._packer.pack(int(time.time()))
         if self._nanosecond_precision and isinstance(timestamp, float):
-            timestamp = EventTime(timestamp)
+            return _pack_event_time(timestamp)
+        return self._packer.pack(timestamp)
+
+    async def _async_emit_packed(self, label, packed_time, data):
+        if self._closing:
+            return False
+        self.metrics.incr("events")
+        if self._metrics_interval is not None and self._metrics_task is None:
+            self._ensure_metrics_task()
+        if self._nonblocking and self._buffered >= self._bufmax:
+            return self._drop_event(label, packed_time, data)
+        if self._packed_forward:
+            return await self._async_add_entry(label, packed_time, data)
+        option = self._make_option()
         try:
-            bytes_ = self._make_packet(label, timestamp, data)
+            bytes_ = self._make_packet(label, packed_time, data, option)
         except Exception as e:
             self.last_error = e
-            bytes_ = self._make_packet(
-                label,
-                timestamp,
-                {
-                    "level": "CRITICAL",
-                    "message": "Can't output to log",
-                    "traceback": traceback.format_exc(),
-                },
-            )
-        return await self._async_send(bytes_)
+            bytes_ = self._make_packet(label, packed_time, self._error_record(), option)
+        if self._nonblocking:
+            self._add_to_buffer(bytes_, option)
+            return True
+        started = time.monotonic()
+        result = await self._async_send(bytes_, option)
+        self.metrics.observe("emit_to_write_seconds", time.monotonic() - started)
+        return result
 
-    def _make_packet(self, label, timestamp, data):
+    def _add_to_buffer(self, bytes_, option):
+        if not self._buffer:
+            self._buffer_started = time.monotonic()
+        self._buffer.append((bytes_, option))
+        self._add_buffered(len(bytes_))
+
+    def _add_buffered(self, size):
+        self._buffered += size
+        if self._buffered >= self._max_batch_size:
+            self.flush_event.set()
+        self._ensure_flush_task()
+
+    def _drop_event(self, label, packed_time, data):
+        try:
+            self._handle_overflow(self._make_packet(label, packed_time, data))
+        except Exception as e:
+            self.last_error = e
+        return False
+
+    def _error_record(self):
+        return {
+            "level": "CRITICAL",
+            "message": "Can't output to log",
+            "traceback": traceback.format_exc(),
+        }
+
+    def _make_tag(self, label):
         if label:
-            tag = ".".join((self._tag, label))
-        else:
-            tag = self._tag
-        packet = (tag, timestamp, data)
+            return ".".join((self._tag, label))
+        return self._tag
+
+    def _make_option(self, option=None):
+        if not self._require_ack:
+            return option
+        if option is None:
+            option = {}
+        option["chunk"] = base64.b64encode(uuid.uuid4().bytes).decode("ascii")
+        return option
+
+    def _pack_tag(self, label):
+        return self._packer.pack(self._make_tag(label))
+
+    def _pack_record(self, data):
+        packed = self._packer.pack(data)
+        if self._static_fields is None or not isinstance(data, dict):
+            return packed
+        # the record's pairs come last, so its keys win over static ones
+        header_size = len(_map_header(len(data)))
+        return b"".join(
+            (
+                _map_header(len(data) + self._static_count),
+                self._static_fields,
+                memoryview(packed)[header_size:],
+            )
+        )
+
+    def _make_packet(self, label, packed_time, data, option=None):
+        if self._verbose:
+            print((self._make_tag(label), packed_time, data, option))
+        record = self._pack_record(data)
+        if option is None:
+            return b"".join((_ARRAY3, self._packed_tag(label), packed_time, record))
+        return b"".join(
+            (
+                _ARRAY4,
+                self._packed_tag(label),
+                packed_time,
+                record,
+                self._packer.pack(option),
+            )
+        )
+
+    def _make_entry(self, packed_time, data):
         if self._verbose:
-            print(packet)
-        return msgpack.packb(packet)
+            print((packed_time, data))
+        return b"".join((_ARRAY2, packed_time, self._pack_record(data)))
+
+    def _make_frame(self, label, entries, option):
+        # entries go out as a msgpack bin
+        return b"".join(
+            (
+                _ARRAY3,
+                self._packed_tag(label),
+                _bin_header(len(entries)),
+                entries,
+                self._packer.pack(option),
+            )
+        )
+
+    async def _async_compress(self, entries):
+        compress = functools.partial(
+            gzip.compress, entries, compresslevel=GZIP_COMPRESS_LEVEL
+        )
+        if len(entries) < self._compress_threshold:
+            return compress()
+        return await asyncio.get_event_loop().run_in_executor(None, compress)
+
+    async def _async_add_entry(self, label, packed_time, data):
+        try:
+            entry = self._make_entry(packed_time, data)
+        except Exception as e:
+            self.last_error = e
+            entry = self._make_entry(packed_time, self._error_record())
+
+        batch = self._batches.get(label)
+        if batch is None:
+            batch = self._batches[label] = _Batch()
+        batch.append(entry)
+        if self._nonblocking:
+            self._add_buffered(len(entry))
+            return True
+        self._buffered += len(entry)
+        if len(batch) >= self._max_batch_size:
+            return await self._async_flush_batch(label)
+        self._ensure_flush_task()
+        return True
+
+    async def _async_flush_batch(self, label):
+        batch = self._batches.pop(label, None)
+        if not batch:
+            return True
+        self._buffered -= len(batch)
+        return await self._async_send_batch(label, batch)
+
+    async def _async_send_batch(self, label, batch):
+        option = self._make_option({"size": batch.size})
+        if self._compressed is None:
+            result = await self._async_send(
+                self._make_frame(label, batch.entries, option), option
+            )
+        else:
+            # frames must leave in order even when compression runs in an
+            # executor
+            async with self.compress_lock:
+                entries = await self._async_compress(batch.entries)
+                option["compressed"] = self._compressed
+                result = await self._async_send(
+                    self._make_frame(label, entries, option), option
+                )
+        # latency of the oldest entry of the batch
+        self.metrics.observe("emit_to_write_seconds", time.monotonic() - batch.started)
+        return result
+
+    async def flush(self):
+        """Send every batched entry now, regardless of size and interval"""
+        result = await self._async_flush_buffer()
+        for label in list(self._batches):
+            if not await self._async_flush_batch(label):
+                result = False
+        return result
+
+    async def _async_flush_buffer(self):
+        if not self._buffer:
+            return True
+        buffer, self._buffer = self._buffer, []
+        started, self._buffer_started = self._buffer_started, None
+        self._buffered -= sum(len(bytes_) for bytes_, _ in buffer)
+        if not self._require_ack:
+            result = await self._async_send([bytes_ for bytes_, _ in buffer])
+        else:
+            result = True
+            for bytes_, option in buffer:
+                if not await self._async_send(bytes_, option):
+                    result = False
+        # latency of the oldest event of the buffer
+        self.metrics.observe("emit_to_write_seconds", time.monotonic() - started)
+        return result
+
+    def _ensure_flush_task(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_loop())
+
+    async def _flush_loop(self):
+        while self._batches or self._buffer:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_event.clear()
+            await self.flush()
 
-    async def _async_send(self, bytes_):
+    async def _async_send(self, bytes_, option=None):
         try:
-            result = await self._async_send_internal(bytes_)
+            if option is not None and "chunk" in option:
+                result = await self._async_send_acked(bytes_, option["chunk"])
+            else:
+                result = await self._async_send_internal(bytes_)
         except Exception:
             result = None
         return result
 
+    async def _async_send_acked(self, bytes_, chunk):
+        if self._waiting or not await self._wait_for_ack_window():
+            # disconnected or nothing was acked in time, the frame is sent
+            # once the window has room again
+            return self._add_waiting(chunk, bytes_)
+
+        # the frame stays here until acked, and is resent after a reconnect
+        self._inflight[chunk] = bytes_
+        try:
+            writer = await self.get_writer()
+            if writer is None:
+                # sent along the other unacked frames once connected
+                self.metrics.incr("send_failures")
+                return False
+            if self._resend_inflight:
+                self._resend_inflight = False
+                frames = list(self._inflight.values())
+                writer.writelines(frames)
+                self._sent_chunks.update(self._inflight)
+                size = sum(len(frame) for frame in frames)
+                self._send_waiting()
+            elif chunk in self._sent_chunks:
+                # a concurrent send resent it along the other frames in flight
+                size = 0
+            else:
+                writer.write(bytes_)
+                self._sent_chunks.add(chunk)
+                size = len(bytes_)
+            await self._async_drain(writer, size)
+
+            if self._spill:
+                self._ensure_spill_task()
+            return True
+        except (
+            socket.error,
+            asyncio.TimeoutError,
+            asyncio.CancelledError,
+            OSError,
+            BlockingIOError,
+        ) as e:
+            self.last_error = e
+            self.metrics.incr("send_failures")
+            self._connection_lost()
+            return False
+
+    async def _async_resend_inflight(self):
+        self._resend_inflight = False
+        frames = list(self._inflight.values())
+        try:
+            self._writer.writelines(frames)
+            self._sent_chunks.update(self._inflight)
+            self._send_waiting()
+            await self._async_drain(self._writer, sum(len(frame) for frame in frames))
+        except (socket.error, asyncio.TimeoutError, OSError) as e:
+            self.last_error = e
+            self.metrics.incr("send_failures")
+            self._connection_lost()
+
+    def _take_unacked(self):
+        """Take out the `(chunk, frame)` pairs not acked yet, oldest first"""
+        frames = list(self._inflight.items())
+        frames.extend(self._waiting.items())
+        self._inflight.clear()
+        self._sent_chunks.clear()
+        self._resend_inflight = False
+        self._waiting.clear()
+        self._waiting_size = 0
+        return frames
+
+    def _add_waiting(self, chunk, bytes_):
+        if self._waiting_size + len(bytes_) > self._bufmax:
+            self._handle_overflow(bytes_)
+            return False
+        self._waiting[chunk] = bytes_
+        self._waiting_size += len(bytes_)
+        self._send_waiting()
+        # accepted, delivered once the window has room
+        return True
+
+    def _send_waiting(self):
+        """Move waiting frames in flight while the window has room"""
+        writer = self._writer
+        # unacked frames are resent first
+        if writer is None or self._resend_inflight:
+            return
+        frames = []
+        while self._waiting and len(self._inflight) < self._ack_window:
+            chunk, bytes_ = self._waiting.popitem(last=False)
+            self._waiting_size -= len(bytes_)
+            self._inflight[chunk] = bytes_
+            self._sent_chunks.add(chunk)
+            frames.append(bytes_)
+        if frames:
+            # not drained, the window bounds what is written
+            writer.writelines(frames)
+            self.metrics.incr("bytes_written", sum(len(frame) for frame in frames))
+
+    async def _async_drain(self, writer, size):
+        started = time.monotonic()
+        await asyncio.wait_for(writer.drain(), self._timeout)
+        self.metrics.observe("drain_seconds", time.monotonic() - started)
+        self.metrics.incr("bytes_written", size)
+
+    async def _wait_for_ack_window(self):
+        if len(self._inflight) < self._ack_window:
+            return True
+        if self._writer is None:
+            return False
+        try:
+            await asyncio.wait_for(self._ack_window_available(), self._ack_timeout)
+        except asyncio.TimeoutError as e:
+            # fluentd stopped acking, reconnect and resend what is in flight
+            self.last_error = e
+            self._connection_lost()
+            return False
+        return len(self._inflight) < self._ack_window
+
+    async def _ack_window_available(self):
+        while len(self._inflight) >= self._ack_window and self._writer is not None:
+            self.ack_event.clear()
+            await self.ack_event.wait()
+
+    def _start_reader(self):
+        # fluentd only writes acks, but reading also notices when it closed
+        # the connection, before events are written to a half-open socket
+        self._resend_inflight = bool(self._inflight)
+        if self._reader is not None:
+            self._ack_task = asyncio.ensure_future(self._read_acks(self._reader))
+
+    async def _read_acks(self, reader):
+        unpacker = msgpack.Unpacker(raw=False)
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                unpacker.feed(data)
+                for response in unpacker:
+                    if not isinstance(response, dict):
+                        continue
+                    chunk = response.get("ack")
+                    if self._inflight.pop(chunk, None) is not None:
+                        self._sent_chunks.discard(chunk)
+                        self.ack_event.set()
+                        self._send_waiting()
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            self.last_error = ex
+
+        # fluentd closed the connection, unacked frames go out on reconnect
+        if self._reader is reader:
+            self._ack_task = None
+            self._connection_lost()
+        self.ack_event.set()
+
     async def _async_send_internal(self, bytes_):
-        # buffering
-        if self._pendings:
-            self._pendings += bytes_
-            bytes_ = self._pendings
+        # buffering, `bytes_` can also be a list of packets
+        if isinstance(bytes_, list):
+            self._pendings.extend(bytes_)
+        else:
+            self._pendings.append(bytes_)
 
+        chunks = []
+        writer = None
         try:
             writer = await self.get_writer()
             if writer is None:
-                self.clean(bytes_)
+                self.metrics.incr("send_failures")
+                self.clean()
                 return False
-            writer.write(bytes_)
-            await asyncio.wait_for(writer.drain(), self._timeout)
+            size = len(self._pendings)
+            chunks = self._pendings.take()
+            self._writing.append(chunks)
+            writer.writelines(chunks)
+            await self._async_drain(writer, size)
+            self._written(chunks)
 
-            self._pendings = None
-            self._last_error_time = 0
+            if self._spill:
+                self._ensure_spill_task()
             return True
         except (
             socket.error,
@@ -178,25 +967,98 @@ class FluentSender(object):
             BlockingIOError,
         ) as e:
             self.last_error = e
+            self.metrics.incr("send_failures")
 
-            # Connection error, retry connecting
-            self.clean(bytes_)
-            async with self.lock:
-                self.close()
-            self._writer = self._reader = None
+            # Connection error, retry connecting. Only once per connection,
+            # the first failing send puts back what every send wrote to it
+            if writer is not None and writer is self._writer:
+                self._connection_lost()
+            else:
+                self.clean(chunks if self._written(chunks) else ())
             return False
         except Exception as ex:
             self.last_error = ex
+            self.metrics.incr("send_failures")
             sys.stderr.write("Unhandled exception sending data")
-            self.clean(bytes_)
+            self.clean(chunks if self._written(chunks) else ())
             return False
 
-    def clean(self, bytes_=b""):
-        if self._pendings and (len(self._pendings) > self._bufmax):
-            self._call_buffer_overflow_handler(self._pendings)
-            self._pendings = None
-        else:
-            self._pendings = bytes_
+    def _written(self, chunks):
+        """Stop tracking `chunks`, returns whether they were still tracked"""
+        for idx, written in enumerate(self._writing):
+            if written is chunks:
+                del self._writing[idx]
+                return True
+        return False
+
+    def clean(self, chunks=()):
+        """Keep unsent `chunks` for the next send, unless over `bufmax`"""
+        self._pendings.restore(chunks)
+        if len(self._pendings) > self._bufmax:
+            self._handle_overflow(self._pendings.getvalue())
+            self._pendings.clear()
+
+    def _handle_overflow(self, data):
+        if self._spill is not None and self._spill.append(data):
+            self.metrics.incr("spilled_bytes", len(data))
+            return
+        self.metrics.incr("overflow_bytes", len(data))
+        self._call_buffer_overflow_handler(data)
+
+    def _ensure_spill_task(self):
+        if self._spill_task is None or self._spill_task.done():
+            self._spill_task = asyncio.ensure_future(self.replay_spill())
+
+    async def replay_spill(self):
+        """Send spilled data, oldest first, until done or disconnected.
+
+        Returns the number of bytes sent.
+        """
+        sent = 0
+        # children may have exited since, leaving segments behind
+        self._spill.refresh()
+        while self._spill:
+            self._spill.seal()
+            for path in self._spill.segments():
+                data = self._spill.read(path)
+                if data:
+                    writer = await self.get_writer()
+                    if writer is None:
+                        return sent
+                    try:
+                        writer.write(data)
+                        await self._async_drain(writer, len(data))
+                    except (socket.error, asyncio.TimeoutError, OSError) as e:
+                        self.last_error = e
+                        self.metrics.incr("send_failures")
+                        self._connection_lost()
+                        return sent
+                self._spill.remove(path)
+                sent += len(data)
+        return sent
+
+    def _ensure_metrics_task(self):
+        if self._metrics_task is None or self._metrics_task.done():
+            self._metrics_task = asyncio.ensure_future(self._metrics_loop())
+
+    async def _metrics_loop(self):
+        # sending swallows cancellation, stop once `close` dropped the task
+        while self._metrics_task is asyncio.current_task():
+            await asyncio.sleep(self._metrics_interval)
+            await self.report_metrics()
+
+    async def report_metrics(self):
+        """Pass a metrics snapshot to the callback and emit it, returns it"""
+        snapshot = self.metrics.snapshot()
+        if self._metrics_callback is not None:
+            try:
+                self._metrics_callback(snapshot)
+            except Exception:
+                # User should care any exception in callback
+                pass
+        if self._metrics_label is not None:
+            await self.async_emit(self._metrics_label, snapshot)
+        return snapshot
 
     def _call_buffer_overflow_handler(self, pending_events):
         try:
@@ -214,20 +1076,168 @@ class FluentSender(object):
     def last_error(self, err):
         if err is not None:
             self._last_error = err
-            self._last_error_time = time.time()
         else:
             self.clear_last_error()
 
     def clear_last_error(self):
         self._last_error = None
-        self._last_error_time = 0
+
+    def _after_fork(self):
+        """Forget the connection, tasks and buffers inherited from the parent"""
+        # the socket is shared with the parent, writing to it would interleave
+        # with its frames, and the tasks and locks belong to its event loop
+        self._reader = None
+        self._writer = None
+        self._flush_task = None
+        self._flush_event = None
+        self._spill_task = None
+        self._compress_lock = None
+        self._ack_task = None
+        self._ack_event = None
+        self._metrics_task = None
+        self._connect_task = None
+        self._attempt = None
+        self._reconnect_attempts = 0
+        self._reconnect_at = 0
+        self._connected = False
+        # buffered events are sent by the parent, and so are its spill files
+        self._pendings.clear()
+        self._writing.clear()
+        self._batches = {}
+        self._buffer = []
+        self._buffer_started = None
+        self._buffered = 0
+        self._inflight.clear()
+        self._resend_inflight = False
+        self._sent_chunks.clear()
+        self._waiting.clear()
+        self._waiting_size = 0
+        self._closing = False
+        self.clear_last_error()
+        if self._spill is not None:
+            self._spill = self._child_spill()
+
+    def _child_spill(self):
+        try:
+            return SpillBuffer(
+                os.path.join(self._spill_dir, str(os.getpid())),
+                segment_size=self._spill.segment_size,
+                max_size=self._spill.max_size,
+            )
+        except OSError as ex:
+            self.last_error = ex
+            return None
+
+    async def aclose(self, timeout=None):
+        """Refuse new events, send the buffered ones and close.
+
+        What is not sent within `timeout` seconds, the sender's `timeout` by
+        default, is spilled with `spill_dir`, or passed to the buffer overflow
+        handler. Returns the bytes `flushed_bytes`, `spilled_bytes` and
+        `dropped_bytes` while closing.
+        """
+        self._closing = True
+        _cancel_task(self._metrics_task)
+        self._metrics_task = None
+        counters = self.metrics.counters
+        before = (
+            counters["bytes_written"],
+            counters["spilled_bytes"],
+            counters["overflow_bytes"],
+        )
+        deadline = time.monotonic() + (self._timeout if timeout is None else timeout)
+        try:
+            await asyncio.wait_for(
+                self._drain(deadline), max(deadline - time.monotonic(), 0)
+            )
+        except asyncio.TimeoutError:
+            pass
+        unsent = self._take_unsent()
+        if unsent:
+            self._handle_overflow(unsent)
+        tasks = [
+            task
+            for task in (
+                self._flush_task,
+                self._spill_task,
+                self._ack_task,
+                self._connect_task,
+                self._attempt,
+            )
+            if task is not None and not task.done()
+        ]
+        self.close()
+        # with nothing left to send, the cancelled tasks end right away
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return {
+            "flushed_bytes": counters["bytes_written"] - before[0],
+            "spilled_bytes": counters["spilled_bytes"] - before[1],
+            "dropped_bytes": counters["overflow_bytes"] - before[2],
+        }
+
+    def _has_unsent(self):
+        return any(
+            (self._batches, self._buffer, self._pendings, self._inflight, self._waiting)
+        )
+
+    async def _drain(self, deadline):
+        # sends swallow cancellation, the deadline is checked here as well
+        while self._has_unsent() and time.monotonic() < deadline:
+            # connecting is not put on hold anymore
+            sent = await self.connect() and await self.flush()
+            if sent and self._pendings:
+                sent = await self._async_send_internal([])
+            if sent and await self._wait_for_acks():
+                continue
+            await asyncio.sleep(min(0.1, max(deadline - time.monotonic(), 0)))
+
+    async def _wait_for_acks(self):
+        while self._inflight and self._writer is not None:
+            self.ack_event.clear()
+            await self.ack_event.wait()
+        return not self._inflight
+
+    def _take_unsent(self):
+        """Everything not sent yet as a single chunk, oldest first"""
+        chunks = list(self._inflight.values())
+        chunks.extend(self._waiting.values())
+        chunks.extend(self._pendings.take())
+        chunks.extend(bytes_ for bytes_, _ in self._buffer)
+        for label, batch in self._batches.items():
+            option = self._make_option({"size": batch.size})
+            chunks.append(self._make_frame(label, batch.entries, option))
+        self._inflight.clear()
+        self._sent_chunks.clear()
+        self._waiting.clear()
+        self._waiting_size = 0
+        self._buffer = []
+        self._buffer_started = None
+        self._batches = {}
+        self._buffered = 0
+        return b"".join(chunks)
 
     def close(self):
+        _cancel_task(self._connect_task)
+        self._connect_task = None
+        _cancel_task(self._attempt)
+        _cancel_task(self._flush_task)
+        _cancel_task(self._metrics_task)
+        self._metrics_task = None
+        _cancel_task(self._spill_task)
+        if self._spill is not None:
+            self._spill.close()
+        self._close_connection()
+        # events sent after closing connect again like the first ones
+        self._connected = False
+
+    def _close_connection(self):
+        _cancel_task(self._ack_task)
+        self._ack_task = None
         if self._writer is not None:
             try:
                 self._writer.close()
             except RuntimeError:
                 # event loop already closed
                 pass
-            self._reader = None
-            self._writer = None
+        self._reader = None
+        self._writer = None
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""Disk spill buffer for events that do not fit in the sender's memory buffer.
+
+Overflowed data is appended to memory-mapped segment files in a directory.
+Segments are replayed oldest first once fluentd is reachable again, either by
+the sender itself or, after a crash, with::
+
+    $ python -m aiofluent.spill /var/spool/aiofluent --host fluentd --port 24224
+"""
+
+import argparse
+import asyncio
+import mmap
+import os
+import struct
+import sys
+import time
+
+SEGMENT_SUFFIX = ".spill"
+SEGMENT_MAGIC = b"AIOFLSP1"
+# magic followed by the number of bytes used in the segment
+_SEGMENT_HEADER = struct.Struct(">8sQ")
+
+
+class _Segment(object):
+    """Segment file being written, mapped in memory"""
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.used = 0
+        self._file = open(path, "w+b")
+        self._file.truncate(_SEGMENT_HEADER.size + capacity)
+        self._map = mmap.mmap(self._file.fileno(), _SEGMENT_HEADER.size + capacity)
+        self._write_header()
+
+    def _write_header(self):
+        _SEGMENT_HEADER.pack_into(self._map, 0, SEGMENT_MAGIC, self.used)
+
+    def append(self, data):
+        if self.used + len(data) > self.capacity:
+            return False
+        self._map.seek(_SEGMENT_HEADER.size + self.used)
+        self._map.write(data)
+        self.used += len(data)
+        # written last, a crash never exposes a partially copied append
+        self._write_header()
+        return True
+
+    def seal(self):
+        """Close the mapping and trim the file to the data it holds"""
+        self._map.close()
+        self._file.truncate(_SEGMENT_HEADER.size + self.used)
+        self._file.close()
+
+
+def _alive(pid):
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # exists, owned by another user
+        return True
+    return True
+
+
+def _segment_paths(directory):
+    """Segments in `directory` and in those left by dead child processes"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    paths = []
+    for name in names:
+        path = os.path.join(directory, name)
+        if name.endswith(SEGMENT_SUFFIX):
+            paths.append(path)
+        elif name.isdigit() and not _alive(int(name)) and os.path.isdir(path):
+            children = _segment_paths(path)
+            if children:
+                paths.extend(children)
+            else:
+                _remove_directory(path)
+    return paths
+
+
+def _remove_directory(path):
+    try:
+        os.rmdir(path)
+    except OSError:
+        # not empty anymore, or already removed
+        pass
+
+
+class SpillBuffer(object):
+    """Append-only, size capped, spill files in `directory`.
+
+    Forked children spill to a subdirectory named after their pid, created
+    on their first spill. Once the child is gone, its segments are replayed
+    and counted in `max_size` along those of `directory`.
+
+    :param directory: where segments are stored, one directory per sender.
+    :param segment_size: bytes a segment holds before rotating to a new one.
+    :param max_size: bytes allowed on disk, appends over it are refused.
+    """
+
+    def __init__(
+        self, directory, segment_size=8 * 1024 * 1024, max_size=256 * 1024 * 1024
+    ):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self._current = None
+        self._last_name = 0
+
+        # segments left behind by a previous process
+        self._size = 0
+        self.refresh()
+
+    def __len__(self):
+        return self._size
+
+    def _segment_path(self):
+        # names sort in creation order, also across restarts
+        self._last_name = max(time.time_ns(), self._last_name + 1)
+        return os.path.join(
+            self.directory, "{:020d}{}".format(self._last_name, SEGMENT_SUFFIX)
+        )
+
+    def append(self, data):
+        """Store `data`, returns `False` when it would exceed `max_size`"""
+        if self._size + len(data) > self.max_size:
+            return False
+        if self._current is None or not self._current.append(data):
+            self.seal()
+            os.makedirs(self.directory, exist_ok=True)
+            self._current = _Segment(
+                self._segment_path(), max(self.segment_size, len(data))
+            )
+            self._current.append(data)
+        self._size += len(data)
+        return True
+
+    def seal(self):
+        """Finish the segment being written so it can be replayed"""
+        if self._current is not None:
+            self._current.seal()
+            self._current = None
+
+    def segments(self):
+        """Sealed segment paths, oldest first"""
+        # names are creation times, also in the directories of children
+        paths = sorted(_segment_paths(self.directory), key=os.path.basename)
+        if self._current is not None:
+            paths.remove(self._current.path)
+        return paths
+
+    def refresh(self):
+        """Count the segments on disk again, picking up those of children
+        that exited since, returns the size"""
+        self._size = sum(self._used(path) for path in self.segments())
+        if self._current is not None:
+            self._size += self._current.used
+        return self._size
+
+    @staticmethod
+    def _used(path):
+        with open(path, "rb") as fi:
+            header = fi.read(_SEGMENT_HEADER.size)
+        if len(header) < _SEGMENT_HEADER.size:
+            return 0
+        magic, used = _SEGMENT_HEADER.unpack(header)
+        if magic != SEGMENT_MAGIC:
+            return 0
+        return used
+
+    def read(self, path):
+        used = self._used(path)
+        with open(path, "rb") as fi:
+            fi.seek(_SEGMENT_HEADER.size)
+            return fi.read(used)
+
+    def remove(self, path):
+        self._size = max(0, self._size - self._used(path))
+        os.remove(path)
+        directory = os.path.dirname(path)
+        if directory != self.directory and not os.listdir(directory):
+            # the last segment of a dead child
+            _remove_directory(directory)
+
+    def close(self):
+        self.seal()
+
+
+async def replay(directory, host="localhost", port=24224, timeout=3):
+    """Send the segments left in `directory`, returns the bytes sent"""
+    from aiofluent.sender import FluentSender
+
+    sender = FluentSender(
+        "", host=host, port=port, timeout=timeout, spill_dir=directory
+    )
+    try:
+        return await sender.replay_spill()
+    finally:
+        sender.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay aiofluent spill segments")
+    parser.add_argument("directory")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=24224)
+    parser.add_argument("--timeout", type=float, default=3)
+    args = parser.parse_args(argv)
+
+    sent = asyncio.run(replay(args.directory, args.host, args.port, args.timeout))
+    left = SpillBuffer(args.directory)
+    sys.stdout.write("Replayed {} bytes, {} bytes left\n".format(sent, len(left)))
+    return 1 if len(left) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""Stub fluentd server speaking the Forward protocol, with fault injection.
+
+It decodes Message, Forward, PackedForward and CompressedPackedForward
+messages, acks chunks, and can misbehave on request, so the buffering and
+reconnects of :class:`FluentSender` can be tested over real sockets::
+
+    async with StubFluentd(ack=True) as server:
+        sender = FluentSender('app', port=server.port, require_ack=True)
+        await sender.async_emit('follow', {'from': 'userA'})
+        await server.wait_for_events(1)
+
+It also runs standalone, printing what it receives::
+
+    $ python -m aiofluent.testing --port 24224
+"""
+
+import argparse
+import asyncio
+import gzip
+import io
+import socket
+import struct
+import sys
+
+import msgpack
+
+# large events are fine, this is not facing the internet
+MAX_MESSAGE_SIZE = 256 * 1024 * 1024
+# SO_LINGER with a zero timeout, closing sends a RST
+_LINGER_RESET = struct.pack("ii", 1, 0)
+_EVENT_TIME = struct.Struct(">II")
+
+
+def _ext_hook(code, data):
+    if code == 0:
+        seconds, nanoseconds = _EVENT_TIME.unpack(data)
+        return seconds + nanoseconds / 10**9
+    return msgpack.ExtType(code, data)
+
+
+def _unpacker(file_like=None):
+    return msgpack.Unpacker(
+        file_like,
+        raw=False,
+        ext_hook=_ext_hook,
+        max_buffer_size=MAX_MESSAGE_SIZE,
+        max_str_len=MAX_MESSAGE_SIZE,
+        max_bin_len=MAX_MESSAGE_SIZE,
+    )
+
+
+def decode_message(message):
+    """`(tag, time, record)` events and the option of a Forward message"""
+    tag, entries = message[0], message[1]
+    option = None
+    if isinstance(entries, (bytes, list)):
+        # Forward, PackedForward or CompressedPackedForward
+        if len(message) > 2:
+            option = message[2]
+        if isinstance(entries, bytes):
+            if option and option.get("compressed") == "gzip":
+                entries = gzip.decompress(entries)
+            entries = list(_unpacker(io.BytesIO(entries)))
+        return [(tag, timestamp, record) for timestamp, record in entries], option
+    # Message
+    if len(message) > 3:
+        option = message[3]
+    return [(tag, message[1], message[2])], option
+
+
+class StubFluentd(object):
+    """In-process Forward protocol server.
+
+    The fault injection attributes can be changed while it runs:
+
+    :param ack: answer the `chunk` option of messages.
+    :param ack_delay: seconds to wait before acking.
+    :param read_delay: seconds to wait before every read of `read_size` bytes,
+      a small `read_size` with a delay makes `drain()` block on the client.
+    :param reset_after: reset connections once they sent more bytes than this.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        ack=False,
+        ack_delay=0,
+        read_delay=0,
+        read_size=64 * 1024,
+        reset_after=None,
+    ):
+        self.host = host
+        self.port = port
+        self.ack = ack
+        self.ack_delay = ack_delay
+        self.read_delay = read_delay
+        self.read_size = read_size
+        self.reset_after = reset_after
+
+        self.events = []
+        self.options = []
+        self.connections = 0
+        self.resets = 0
+        self._server = None
+        self._writers = set()
+        self._tasks = set()
+        self._received = None
+
+    @property
+    def received_event(self):
+        if self._received is None:
+            self._received = asyncio.Event()
+        return self._received
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def start(self):
+        """Listen, also after `refuse`, returns the port"""
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port, reuse_address=True
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    def refuse(self):
+        """Stop listening, new connections are refused until `start`"""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def reset_connections(self):
+        """Reset every open connection"""
+        for writer in list(self._writers):
+            self._reset(writer)
+
+    def _reset(self, writer):
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, _LINGER_RESET)
+        writer.transport.abort()
+        self._writers.discard(writer)
+        self.resets += 1
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self._writers.add(writer)
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        unpacker = _unpacker()
+        received = 0
+        try:
+            while writer in self._writers:
+                if self.read_delay:
+                    await asyncio.sleep(self.read_delay)
+                data = await reader.read(self.read_size)
+                if not data:
+                    break
+                received += len(data)
+                if self.reset_after is not None and received > self.reset_after:
+                    self._reset(writer)
+                    break
+                unpacker.feed(data)
+                for message in unpacker:
+                    self._receive(message, writer)
+        except ConnectionError:
+            pass
+        finally:
+            self._tasks.discard(task)
+            if writer in self._writers:
+                self._writers.discard(writer)
+                writer.close()
+
+    def _receive(self, message, writer):
+        events, option = decode_message(message)
+        self.events.extend(events)
+        self.options.append(option)
+        self.received_event.set()
+        if self.ack and option and "chunk" in option:
+            response = msgpack.packb({"ack": option["chunk"]})
+            if self.ack_delay:
+                asyncio.get_event_loop().call_later(
+                    self.ack_delay, self._write, writer, response
+                )
+            else:
+                self._write(writer, response)
+
+    def _write(self, writer, data):
+        if writer in self._writers and not writer.is_closing():
+            writer.write(data)
+
+    async def wait_for_events(self, number, timeout=5):
+        """Wait until `number` events were received, returns them"""
+
+        async def wait():
+            while len(self.events) < number:
+                self.received_event.clear()
+                await self.received_event.wait()
+
+        await asyncio.wait_for(wait(), timeout)
+        return self.events
+
+    async def close(self):
+        self.refuse()
+        # connection handlers stop on their own once their connection is gone
+        for writer in list(self._writers):
+            self._writers.discard(writer)
+            writer.transport.abort()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def _serve(args):
+    server = StubFluentd(args.host, args.port, ack=args.ack, read_delay=args.read_delay)
+    await server.start()
+    sys.stdout.write("Listening on {}:{}\n".format(args.host, server.port))
+    while True:
+        await server.wait_for_events(1, timeout=None)
+        events, server.events = server.events, []
+        for event in events:
+            sys.stdout.write("{} {} {}\n".format(*event))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stub fluentd server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=24224)
+    parser.add_argument("--ack", action="store_true")
+    parser.add_argument("--read-delay", type=float, default=0)
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmark of the EventTime encoding of `FluentSender.async_emit`.
+
+Compares the previous path, building an `EventTime` from `time.time()` and
+packing it, with the packed fixext8 written from `time.time_ns()`.
+
+    $ pip install -e .
+    $ python benchmarks/event_time.py
+"""
+
+import struct
+import time
+import timeit
+
+import msgpack
+
+from aiofluent.sender import EventTime, _pack_event_time_ns
+
+
+def previous():
+    timestamp = time.time()
+    seconds = int(timestamp)
+    nanoseconds = int(timestamp % 1 * 10**9)
+    return msgpack.packb(msgpack.ExtType(0, struct.pack(">II", seconds, nanoseconds)))
+
+
+def event_time():
+    return msgpack.packb(EventTime(time.time()))
+
+
+def packed():
+    return _pack_event_time_ns(time.time_ns())
+
+
+def main(number=200000, repeat=5):
+    results = {}
+    for func in (previous, event_time, packed):
+        best = min(timeit.repeat(func, number=number, repeat=repeat))
+        results[func.__name__] = best / number * 10**9
+        print("{:<12}{:>10.1f} ns/event".format(func.__name__, results[func.__name__]))
+    print("speedup     {:>10.1f}x".format(results["previous"] / results["packed"]))
+
+
+if __name__ == "__main__":
+    main()
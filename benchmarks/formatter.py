@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmark of `FluentRecordFormatter.format`.
+
+Compares the previous path, running `logging.Formatter.format` and every
+format string against `record.__dict__` and trying to decode every string
+message as JSON, with the compiled fields and the JSON pre-check.
+
+    $ pip install -e .
+    $ python benchmarks/formatter.py
+"""
+
+import json
+import logging
+import timeit
+
+from aiofluent.handler import FluentRecordFormatter
+
+FMT = {
+    "sys_host": "%(hostname)s",
+    "sys_name": "%(name)s",
+    "sys_module": "%(module)s",
+    "where": "%(funcName)s:%(lineno)d",
+}
+
+
+class PreviousFormatter(FluentRecordFormatter):
+    def format(self, record):
+        logging.Formatter.format(self, record)
+        record.hostname = self.hostname
+        data = {}
+        for key, value in self._fmt_dict.items():
+            try:
+                data[key] = value % record.__dict__
+            except (KeyError, TypeError):
+                pass
+        self._structuring(data, record)
+        return data
+
+    def _structuring(self, data, record):
+        msg = record.msg
+        if isinstance(msg, dict):
+            self._add_dic(data, msg)
+        elif isinstance(msg, str):
+            try:
+                self._add_dic(data, json.loads(str(msg)))
+            except ValueError:
+                self._add_dic(data, {"message": record.getMessage()})
+        else:
+            self._add_dic(data, {"message": msg})
+
+    def usesTime(self):
+        return any([value.find("%(asctime)") >= 0 for value in self._fmt_dict.values()])
+
+
+MESSAGES = {
+    "dict": {"event": "login", "user": 1},
+    "text": "user 1 logged in",
+}
+
+
+def main(number=100000, repeat=5):
+    for kind, msg in MESSAGES.items():
+        record = logging.LogRecord("app", logging.INFO, __file__, 42, msg, None, None)
+        results = {}
+        for name, formatter in (
+            ("previous", PreviousFormatter(FMT)),
+            ("compiled", FluentRecordFormatter(FMT)),
+        ):
+            best = min(
+                timeit.repeat(
+                    lambda: formatter.format(record), number=number, repeat=repeat
+                )
+            )
+            results[name] = best / number * 10**9
+            print("{:<5}{:<12}{:>10.1f} ns/record".format(kind, name, results[name]))
+        print(
+            "{:<5}speedup     {:>10.1f}x".format(
+                kind, results["previous"] / results["compiled"]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
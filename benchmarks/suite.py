@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""Throughput and latency of the send and logging hot paths.
+
+Every case sends to a local asyncio TCP sink counting what it receives, and
+reports events/s, bytes/s, p50/p99 latency of a single emit and the memory
+allocated while emitting, measured with `tracemalloc` in a separate, shorter
+run. Results are written as JSON so runs of different commits can be compared:
+
+    $ pip install -e .
+    $ python benchmarks/suite.py --output before.json
+    $ git checkout other-branch
+    $ python benchmarks/suite.py --output after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+from aiofluent import event, handler, sender
+
+RECORD = {"message": "benchmark event", "level": "INFO", "count": 1}
+
+
+class Sink(object):
+    """TCP server counting the bytes it receives"""
+
+    def __init__(self):
+        self.received = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader, writer):
+        while True:
+            data = await reader.read(256 * 1024)
+            if not data:
+                break
+            self.received += len(data)
+        writer.close()
+
+    async def wait_for(self, size, timeout=10):
+        deadline = time.monotonic() + timeout
+        while self.received < size and time.monotonic() < deadline:
+            await asyncio.sleep(0.001)
+
+    def close(self):
+        self._server.close()
+
+
+def _percentile(latencies, percent):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+
+class Case(object):
+    """A benchmarked path, `emit` is called once per event"""
+
+    name = None
+    # bytes/s can not be measured for paths not writing to the sink
+    sends = True
+
+    def __init__(self, port):
+        self.port = port
+
+    async def setup(self):
+        pass
+
+    async def emit(self, idx):
+        raise NotImplementedError
+
+    async def settle(self):
+        """Wait for what was emitted to be written"""
+
+    def bytes_written(self):
+        return 0
+
+    def teardown(self):
+        pass
+
+
+class SenderCase(Case):
+    name = "sender_async_emit"
+
+    async def setup(self):
+        self.sender = sender.FluentSender("bench", host="127.0.0.1", port=self.port)
+
+    async def emit(self, idx):
+        await self.sender.async_emit("event", RECORD)
+
+    def bytes_written(self):
+        return self.sender.metrics.counters["bytes_written"]
+
+    def teardown(self):
+        self.sender.close()
+
+
+class EventCase(SenderCase):
+    name = "send_event"
+
+    async def emit(self, idx):
+        await event.send_event("event", RECORD, sender=self.sender)
+
+
+class AsyncEventCase(SenderCase):
+    name = "async_event"
+
+    async def emit(self, idx):
+        await event.AsyncEvent("event", RECORD, sender=self.sender)()
+
+
+class HandlerCase(Case):
+    name = "handler_logging"
+
+    async def setup(self):
+        handler.FluentHandler._queue_task = None
+        # measures the whole path, nothing is dropped
+        self.handler = handler.FluentHandler(
+            "bench", host="127.0.0.1", port=self.port, queue_size=10**7
+        )
+        self.emitted = 0
+        self.handler.setFormatter(handler.FluentRecordFormatter())
+        self.log = logging.getLogger("aiofluent.benchmark")
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        self.log.handlers = [self.handler]
+
+    async def emit(self, idx):
+        self.log.info("user %s logged in", idx)
+        self.emitted += 1
+        if idx % 100 == 0:
+            # logging is synchronous, let the queue consumer run
+            await asyncio.sleep(0)
+
+    async def settle(self):
+        metrics = self.handler.sender.metrics
+        while metrics.counters["events"] < self.emitted:
+            await asyncio.sleep(0.001)
+        # records are marked done once their batch is drained, and only then
+        # counted in `bytes_written`
+        await handler.FluentHandler._queue.join()
+
+    def bytes_written(self):
+        return self.handler.sender.metrics.counters["bytes_written"]
+
+    def teardown(self):
+        self.log.handlers = []
+        self.handler.close()
+
+
+class FormatterCase(Case):
+    name = "formatter"
+    sends = False
+
+    async def setup(self):
+        self.formatter = handler.FluentRecordFormatter()
+        self.record = logging.LogRecord(
+            "bench", logging.INFO, __file__, 1, "user %s logged in", (1,), None
+        )
+
+    async def emit(self, idx):
+        self.formatter.format(self.record)
+
+
+CASES = (SenderCase, HandlerCase, EventCase, AsyncEventCase, FormatterCase)
+
+
+async def _run(case, number, latencies=None):
+    for idx in range(number):
+        if latencies is None:
+            await case.emit(idx)
+            continue
+        started = time.perf_counter_ns()
+        await case.emit(idx)
+        latencies.append(time.perf_counter_ns() - started)
+    await case.settle()
+
+
+async def run_case(case_class, sink, port, number):
+    case = case_class(port)
+    # everything sent by the previous cases was received
+    base = sink.received
+    await case.setup()
+    # warm up the connection, the caches and the lazily started tasks
+    await _run(case, min(number, 1000))
+    if case.sends:
+        await sink.wait_for(base + case.bytes_written())
+
+    latencies = []
+    received = sink.received
+    started = time.perf_counter()
+    await _run(case, number, latencies)
+    if case.sends:
+        await sink.wait_for(base + case.bytes_written())
+    elapsed = time.perf_counter() - started
+    size = sink.received - received
+
+    tracemalloc.start()
+    await _run(case, max(number // 10, 1))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if case.sends:
+        await sink.wait_for(base + case.bytes_written())
+    case.teardown()
+
+    latencies.sort()
+    return {
+        "events": number,
+        "events_per_sec": number / elapsed,
+        "bytes_per_sec": size / elapsed if case.sends else None,
+        "p50_us": _percentile(latencies, 50) / 1000,
+        "p99_us": _percentile(latencies, 99) / 1000,
+        "peak_alloc_bytes_per_event": peak / max(number // 10, 1),
+    }
+
+
+def _commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(number, names=None):
+    sink = Sink()
+    port = await sink.start()
+    results = {}
+    try:
+        for case_class in CASES:
+            if names and case_class.name not in names:
+                continue
+            results[case_class.name] = await run_case(case_class, sink, port, number)
+    finally:
+        # let the sink read the end of the streams
+        await asyncio.sleep(0.1)
+        sink.close()
+    return {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "time": time.time(),
+        "results": results,
+    }
+
+
+def report(run, baseline=None):
+    for name, result in run["results"].items():
+        line = "{:<20}{:>12.0f} events/s{:>10.1f} us p50{:>10.1f} us p99".format(
+            name, result["events_per_sec"], result["p50_us"], result["p99_us"]
+        )
+        previous = (baseline or {}).get("results", {}).get(name)
+        if previous:
+            line += "{:>+10.1%} events/s".format(
+                result["events_per_sec"] / previous["events_per_sec"] - 1
+            )
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="aiofluent benchmark suite")
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--case", action="append", help="only run these cases")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args.number, args.case))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fi:
+            baseline = json.load(fi)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as fo:
+            json.dump(results, fo, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Compare `FluentSender` over loopback TCP and over a unix domain socket.
+
+A local asyncio server discards what it receives, so the numbers only cover
+the client side: events per second and CPU time per event.
+
+    $ pip install -e .
+    $ python benchmarks/unix_socket.py
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+
+from aiofluent.sender import FluentSender
+
+
+async def _discard(reader, writer):
+    while await reader.read(256 * 1024):
+        pass
+    writer.close()
+
+
+async def run(host, port, number):
+    sender = FluentSender("bench", host=host, port=port)
+    record = {"message": "benchmark event", "level": "INFO", "count": 1}
+    await sender.async_emit("warmup", record)
+
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    for _ in range(number):
+        await sender.async_emit("event", record)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    sender.close()
+    # let the server read the end of the stream
+    await asyncio.sleep(0.1)
+    return number / elapsed, cpu / number * 10**6
+
+
+async def main(number=50000):
+    tcp = await asyncio.start_server(_discard, "127.0.0.1", 0)
+    tcp_port = tcp.sockets[0].getsockname()[1]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "fluent.sock")
+        unix = await asyncio.start_unix_server(_discard, path)
+        results = {
+            "tcp": await run("127.0.0.1", tcp_port, number),
+            "unix": await run("unix://" + path, None, number),
+        }
+        unix.close()
+    tcp.close()
+
+    for name, (rate, cpu) in results.items():
+        print("{:<6}{:>12.0f} events/s{:>10.2f} us cpu/event".format(name, rate, cpu))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +1,33 @@
 # -*- coding: utf-8 -*-
 from io import BytesIO
-from msgpack import Unpacker
+import gzip
+from msgpack import packb, Unpacker
+
+import asyncio
+
+
+class Reader:
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._eof = False
+        self._event = asyncio.Event()
+
+    def feed_data(self, data):
+        self._buf += data
+        self._event.set()
+
+    def feed_eof(self):
+        self._eof = True
+        self._event.set()
+
+    async def read(self, n=-1):
+        while not self._buf and not self._eof:
+            self._event.clear()
+            await self._event.wait()
+        data = bytes(self._buf)
+        self._buf.clear()
+        return data
 
 
 class Writer:
@@ -10,6 +37,12 @@ class Writer:
 
     def write(self, data):
         self.server._buf.write(data)
+        if self.server.ack:
+            self.server.send_acks(data)
+
+    def writelines(self, data):
+        for item in data:
+            self.write(item)
 
     async def drain(self):
         pass
@@ -20,13 +53,41 @@ class Writer:
 
 class MockRecvServer:
 
-    def __init__(self):
+    def __init__(self, ack=False):
         self._writer = Writer(self)
+        self._reader = None
         self._buf = BytesIO()
+        self._unpacker = Unpacker(raw=False)
+        self.ack = ack
+        self.connections = 0
 
     async def factory(self, sender):
-        return None, self._writer
+        self.connections += 1
+        self._reader = Reader()
+        return self._reader, self._writer
+
+    def send_acks(self, data):
+        self._unpacker.feed(data)
+        for message in self._unpacker:
+            option = message[-1]
+            if isinstance(option, dict) and 'chunk' in option:
+                self._reader.feed_data(packb({'ack': option['chunk']}))
 
     def get_recieved(self):
         self._buf.seek(0)
         return list(Unpacker(self._buf, encoding='utf-8'))
+
+    def get_events(self):
+        """(tag, time, record) of every event, PackedForward frames expanded"""
+        events = []
+        for message in self.get_recieved():
+            if isinstance(message[1], bytes):
+                entries = message[1]
+                if message[2].get('compressed') == 'gzip':
+                    entries = gzip.decompress(entries)
+                for timestamp, record in Unpacker(
+                        BytesIO(entries), raw=False):
+                    events.append((message[0], timestamp, record))
+            else:
+                events.append(tuple(message[:3]))
+        return events
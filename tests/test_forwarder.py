@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from aiofluent import forwarder
+import aiofluent.sender
+import asyncio
+import pytest
+
+
+def test_split_frames():
+    framed = bytearray()
+    for packet in (b'abc', b'', b'defg'):
+        framed += forwarder._FRAME_HEADER.pack(len(packet)) + packet
+    partial = forwarder._FRAME_HEADER.pack(5) + b'hi'
+    packets, used = forwarder._split_frames(framed + partial)
+    assert [b'abc', b'', b'defg'] == packets
+    assert len(framed) == used
+
+
+@pytest.mark.asyncio
+async def test_forwarder(tmpdir, mock_server):
+    path = str(tmpdir.join('forwarder.sock'))
+    server = forwarder.Forwarder(path, connection_factory=mock_server.factory)
+    await server.start()
+
+    workers = [
+        aiofluent.sender.FluentSender(
+            'app', host='unix://' + path,
+            connection_factory=forwarder.connection_factory)
+        for _ in range(3)
+    ]
+    for count in range(5):
+        for idx, worker in enumerate(workers):
+            assert await worker.async_emit('w{}'.format(idx), {'count': count})
+    for worker in workers:
+        worker.close()
+    for _ in range(100):
+        if len(mock_server.get_events()) == 15:
+            break
+        await asyncio.sleep(0.01)
+    await server.close()
+
+    # a single connection to fluentd for every worker
+    assert 1 == mock_server.connections
+    events = mock_server.get_events()
+    for idx in range(3):
+        assert list(range(5)) == [
+            e[2]['count'] for e in events if e[0] == 'app.w{}'.format(idx)]
@@ -1,7 +1,13 @@
 import aiofluent.handler
+from aiofluent.testing import StubFluentd
 from unittest.mock import patch
 import asyncio
+import json
 import logging
+import os
+import sys
+import threading
+import time
 import pytest
 
 async def wait_for_queue(handler):
@@ -236,3 +242,496 @@ async def test_discard_message_over_limit_does_not_space_stderr(mock_server):
         stderr.assert_not_called()
 
     handler.close()
+
+
+def test_threaded_handler(mock_server):
+    handler = aiofluent.handler.ThreadedFluentHandler(
+        'app.follow', connection_factory=mock_server.factory)
+    handler.setFormatter(aiofluent.handler.FluentRecordFormatter())
+    log = logging.getLogger('fluent.test.threaded')
+    log.setLevel(logging.INFO)
+    log.handlers = []
+    log.addHandler(handler)
+
+    def worker(idx):
+        for count in range(10):
+            log.info({'worker': idx, 'count': count})
+
+    # no event loop running in any of these threads
+    threads = [threading.Thread(target=worker, args=(idx,)) for idx in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    handler.close()
+
+    data = mock_server.get_events()
+    assert 40 == len(data)
+    for idx in range(4):
+        assert list(range(10)) == [
+            m[2]['count'] for m in data if m[2]['worker'] == idx]
+    assert not handler._thread.is_alive()
+
+
+def test_threaded_handler_discards_over_limit(mock_server):
+    handler = aiofluent.handler.ThreadedFluentHandler(
+        'app.follow', connection_factory=mock_server.factory)
+    handler._thread = threading.Thread()
+    record = logging.makeLogRecord({'msg': 'hello'})
+    for _ in range(aiofluent.handler.MAX_QUEUE_SIZE + 10):
+        handler.emit(record)
+    assert aiofluent.handler.MAX_QUEUE_SIZE == handler.qsize()
+
+
+@pytest.mark.asyncio
+async def test_batched_queue(mock_server):
+    aiofluent.handler.FluentHandler._queue_task = None
+    handler = aiofluent.handler.FluentHandler(
+        'app.follow', connection_factory=mock_server.factory, batch_size=5)
+    handler.setFormatter(aiofluent.handler.FluentRecordFormatter())
+    log = logging.getLogger('fluent.test')
+    log.setLevel(logging.INFO)
+    log.handlers = []
+    log.addHandler(handler)
+    for idx in range(12):
+        log.info({'idx': idx})
+    await wait_for_queue(handler)
+    await asyncio.sleep(0.01)
+    handler.close()
+
+    data = mock_server.get_recieved()
+    # records are sent in batches of up to five
+    assert [5, 5, 2] == [
+        m[2]['size'] if isinstance(m[1], bytes) else 1 for m in data]
+    events = mock_server.get_events()
+    assert ['app.follow'] * 12 == [e[0] for e in events]
+    assert list(range(12)) == [e[2]['idx'] for e in events]
+
+
+def _overflow_handler(mock_server, **kwargs):
+    handler = aiofluent.handler.FluentHandler(
+        'app.follow', connection_factory=mock_server.factory, **kwargs)
+    aiofluent.handler.FluentHandler._queue_task = MockQueueTask()
+    aiofluent.handler.FluentHandler._queue = aiofluent.handler.LogQueue(
+        maxsize=3)
+    return handler
+
+
+def _record(msg, level=logging.INFO):
+    return logging.LogRecord('fluent.test', level, __file__, 1, msg, None, None)
+
+
+def _queued_messages(handler):
+    return [item[0].msg for item in handler._queue._queue._queue]
+
+
+@pytest.mark.asyncio
+async def test_queue_limits_are_per_handler(mock_server):
+    small = aiofluent.handler.FluentHandler(
+        'app.small', connection_factory=mock_server.factory, queue_size=2,
+        batch_size=2)
+    large = aiofluent.handler.FluentHandler(
+        'app.large', connection_factory=mock_server.factory, queue_size=5,
+        overflow_policy='drop_oldest')
+    aiofluent.handler.FluentHandler._queue_task = MockQueueTask()
+    aiofluent.handler.FluentHandler._queue = aiofluent.handler.LogQueue(
+        batch_size=2)
+    for idx in range(6):
+        small.emit(_record(idx))
+        large.emit(_record(idx))
+    assert (2, 5) == (small.qsize(), large.qsize())
+    assert {'INFO': 4} == small.dropped
+    # only the handler's own oldest record made room
+    assert {'INFO': 1} == large.dropped
+    assert [0, 1, 1, 2, 3, 4, 5] == _queued_messages(small)
+
+    # the consumer takes enough for the largest batch, split per handler
+    aiofluent.handler.FluentHandler._queue_task = asyncio.ensure_future(
+        aiofluent.handler.FluentHandler._queue.consume_queue(
+            _record('first'), small))
+    await wait_for_queue(small)
+    await asyncio.sleep(0.01)
+    sizes = [m[2]['size'] if isinstance(m[1], bytes) else 1
+             for m in mock_server.get_recieved()]
+    assert [2, 1, 5] == sizes
+    small.close()
+    large.close()
+    aiofluent.handler.FluentHandler._queue_task = None
+
+
+@pytest.mark.asyncio
+async def test_overflow_drop_oldest(mock_server):
+    handler = _overflow_handler(mock_server, overflow_policy='drop_oldest')
+    for idx in range(5):
+        handler.emit(_record(idx))
+    assert [2, 3, 4] == _queued_messages(handler)
+    assert {'INFO': 2} == handler.dropped
+    handler.close()
+
+
+@pytest.mark.asyncio
+async def test_overflow_drop_level(mock_server):
+    handler = _overflow_handler(mock_server, overflow_policy='drop_level')
+    for idx in range(4):
+        handler.emit(_record(idx, logging.DEBUG))
+    handler.emit(_record('boom', logging.ERROR))
+    # the newest debug record was dropped, then the oldest made room
+    assert [1, 2, 'boom'] == _queued_messages(handler)
+    assert {'DEBUG': 2} == handler.dropped
+
+    for _ in range(3):
+        handler.emit(_record('boom', logging.ERROR))
+    # nothing left to shed, errors are dropped once the queue is all errors
+    assert ['boom'] * 3 == _queued_messages(handler)
+    assert {'DEBUG': 4, 'ERROR': 1} == handler.dropped
+    handler.close()
+
+
+def test_overflow_policy_validated(mock_server):
+    with pytest.raises(ValueError):
+        aiofluent.handler.FluentHandler(
+            'app.follow', connection_factory=mock_server.factory,
+            overflow_policy='block')
+
+
+def test_threaded_handler_blocks_when_full(mock_server):
+    handler = aiofluent.handler.ThreadedFluentHandler(
+        'app.follow', connection_factory=mock_server.factory,
+        queue_size=2, overflow_policy='block', block_timeout=0.5)
+    # no consumer running
+    handler._thread = threading.Thread()
+    record = _record('hello')
+    handler.emit(record)
+    handler.emit(record)
+
+    def consume():
+        with handler._not_full:
+            handler._records.popleft()
+            handler._not_full.notify_all()
+
+    timer = threading.Timer(0.05, consume)
+    timer.start()
+    start = time.time()
+    handler.emit(record)
+    assert time.time() - start < 0.5
+    assert 2 == handler.qsize()
+    assert not handler.dropped
+
+    handler.block_timeout = 0.01
+    handler.emit(record)
+    assert 2 == handler.qsize()
+    assert {'INFO': 1} == handler.dropped
+
+
+def test_formatter_compiled_fields():
+    formatter = aiofluent.handler.FluentRecordFormatter(fmt={
+        'name': '%(name)s',
+        'where': '%(module)s:%(lineno)d',
+        'missing': '%(nope)s',
+        'bad': '%(lineno)d %(nope)d',
+    })
+    assert not formatter.usesTime()
+    record = _record('hello %s', logging.WARNING)
+    record.args = ('world',)
+    data = formatter.format(record)
+    assert {
+        'name': 'fluent.test', 'where': 'test_handler:1',
+        'message': 'hello world'} == data
+    # nothing refers to them, so they are not computed
+    assert not hasattr(record, 'asctime')
+    assert not hasattr(record, 'message')
+
+
+def test_formatter_computes_used_attributes():
+    formatter = aiofluent.handler.FluentRecordFormatter(fmt={
+        'emitted_at': '%(asctime)s',
+        'text': '%(message)s',
+        'exc': '%(exc_text)s',
+    })
+    assert formatter.usesTime()
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        record = logging.LogRecord(
+            'fluent.test', logging.ERROR, __file__, 1, 'failed', None,
+            sys.exc_info())
+    data = formatter.format(record)
+    assert record.asctime == data['emitted_at']
+    assert 'failed' == data['text']
+    assert 'ValueError: boom' in data['exc']
+
+
+def _format(msg, **kwargs):
+    formatter = aiofluent.handler.FluentRecordFormatter(
+        fmt={'name': '%(name)s'}, **kwargs)
+    data = formatter.format(_record(msg))
+    assert 'fluent.test' == data.pop('name')
+    return data
+
+
+def test_formatter_json_messages():
+    assert {'key': 'value'} == _format(' {"key": "value"}')
+    assert {'message': '{not json'} == _format('{not json')
+    assert {'message': '[1, 2]'} == _format('[1, 2]')
+    with patch('aiofluent.handler._json_loads') as loads:
+        _format('plain text')
+        loads.assert_not_called()
+
+
+def test_formatter_json_messages_stdlib_decoder():
+    with patch('aiofluent.handler._json_loads', json.loads):
+        assert {'key': 'value'} == _format('{"key": "value"}')
+        assert {'message': '{not json'} == _format('{not json')
+
+
+def test_formatter_json_opt_out():
+    assert {'message': '{"key": "value"}'} == _format(
+        '{"key": "value"}', parse_json=False)
+
+
+def test_threaded_handler_reset_after_fork(mock_server):
+    handler = aiofluent.handler.ThreadedFluentHandler(
+        'app.follow', connection_factory=mock_server.factory)
+    handler._thread = threading.Thread()
+    handler.emit(_record('parent'))
+    aiofluent.handler.FluentHandler._queue_task = MockQueueTask()
+    pid = os.fork()
+    if pid == 0:
+        ok = (handler._thread is None and not handler.qsize()
+              and aiofluent.handler.FluentHandler._queue_task is None)
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert 0 == status
+    assert 1 == handler.qsize()
+    aiofluent.handler.FluentHandler._queue_task = None
+
+
+def _repeat(msg, created, lineno=1):
+    record = logging.LogRecord(
+        'fluent.test', logging.INFO, __file__, lineno, msg, (created,), None)
+    record.created = created
+    return record
+
+
+def test_repeat_collapser():
+    collapser = aiofluent.handler.RepeatCollapser(10)
+    assert collapser.collapse(_repeat('retry %s', 100))
+    assert not collapser.collapse(_repeat('retry %s', 101))
+    assert not collapser.collapse(_repeat('retry %s', 105))
+    # other call sites and messages are not repeats
+    assert collapser.collapse(_repeat('retry %s', 102, lineno=2))
+    assert collapser.collapse(_repeat('other', 103))
+    assert collapser.collapse(_repeat({'msg': 'dict'}, 103))
+    assert collapser.collapse(_repeat({'msg': 'dict'}, 103))
+    assert 110 == collapser.next_expiry()
+    assert [] == collapser.expired(109)
+
+    summary, = collapser.expired(110)
+    assert 'retry 105' == summary.getMessage()
+    assert (2, 100, 105) == (
+        summary.repeat_count, summary.repeat_first, summary.repeat_last)
+    # a new window starts with the next record
+    assert collapser.collapse(_repeat('retry %s', 111))
+    assert [] == collapser.flush()
+    assert collapser.next_expiry() is None
+
+
+def test_threaded_handler_collapses_repeats(mock_server):
+    handler = aiofluent.handler.ThreadedFluentHandler(
+        'app.follow', connection_factory=mock_server.factory,
+        collapse_window=60)
+    handler.setFormatter(aiofluent.handler.FluentRecordFormatter(
+        fmt={'name': '%(name)s'}))
+    log = logging.getLogger('fluent.test.collapse')
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.handlers = [handler]
+    for idx in range(100):
+        log.info('connection refused, attempt %s', idx)
+    log.warning('giving up')
+    handler.close()
+
+    events = [e[2] for e in mock_server.get_events()]
+    assert ['connection refused, attempt 0', 'giving up',
+            'connection refused, attempt 99'] == [e['message'] for e in events]
+    assert 'repeat_count' not in events[0]
+    assert 99 == events[2]['repeat_count']
+    assert events[2]['repeat_first'] <= events[2]['repeat_last']
+    assert 99 == handler.sender.metrics.counters['repeats_collapsed']
+
+
+def test_threaded_handler_sends_summary_after_window(mock_server):
+    handler = aiofluent.handler.ThreadedFluentHandler(
+        'app.follow', connection_factory=mock_server.factory,
+        collapse_window=0.05)
+    handler.setFormatter(aiofluent.handler.FluentRecordFormatter())
+    log = logging.getLogger('fluent.test.collapse')
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.handlers = [handler]
+    for _ in range(5):
+        log.info('timeout')
+    # nothing else is logged, the summary is sent when the window is over
+    for _ in range(100):
+        if len(mock_server.get_events()) > 1:
+            break
+        time.sleep(0.01)
+    events = [e[2] for e in mock_server.get_events()]
+    handler.close()
+    assert [None, 4] == [e.get('repeat_count') for e in events]
+
+
+def test_threaded_handler_flush_cancels_summary_timer(mock_server):
+    handler = aiofluent.handler.ThreadedFluentHandler(
+        'app.follow', connection_factory=mock_server.factory,
+        collapse_window=0.05)
+    handler.setFormatter(aiofluent.handler.FluentRecordFormatter())
+    calls = []
+    handler._send_summaries = lambda: calls.append(1)
+    log = logging.getLogger('fluent.test.collapse')
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.handlers = [handler]
+    for _ in range(3):
+        log.info('timeout')
+    time.sleep(0.01)
+    # the summary is sent now, the timer does not fire anymore
+    handler._flush_summaries()
+    time.sleep(0.1)
+    handler.close()
+    assert [] == calls
+    events = [e[2] for e in mock_server.get_events()]
+    assert [None, 2] == [e.get('repeat_count') for e in events]
+
+
+@pytest.mark.asyncio
+async def test_collapses_repeats(mock_server):
+    aiofluent.handler.FluentHandler._queue_task = None
+    handler = aiofluent.handler.FluentHandler(
+        'app.follow', connection_factory=mock_server.factory,
+        collapse_window=0.05)
+    handler.setFormatter(aiofluent.handler.FluentRecordFormatter())
+    log = logging.getLogger('fluent.test.collapse')
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.handlers = [handler]
+    for _ in range(3):
+        log.info('timeout')
+    for _ in range(100):
+        if len(mock_server.get_events()) > 1:
+            break
+        await asyncio.sleep(0.01)
+    await wait_for_queue(handler)
+    await asyncio.sleep(0.01)
+    handler.close()
+
+    assert [None, 2] == [
+        e[2].get('repeat_count') for e in mock_server.get_events()]
+
+
+@pytest.mark.asyncio
+async def test_aclose_sends_queued_records(mock_server):
+    aiofluent.handler.FluentHandler._queue_task = None
+    handler = aiofluent.handler.FluentHandler(
+        'app.follow', connection_factory=mock_server.factory,
+        nonblocking=True, flush_interval=60)
+    handler.setFormatter(aiofluent.handler.FluentRecordFormatter())
+    log = logging.getLogger('fluent.test.aclose')
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.handlers = [handler]
+    for idx in range(5):
+        log.info({'idx': idx})
+
+    report = await handler.aclose(timeout=1)
+    log.info({'idx': 5})
+    assert list(range(5)) == [e[2]['idx'] for e in mock_server.get_events()]
+    # the first record started the queue consumer, it is counted as well
+    assert (5, 0) == (report['flushed_records'], report['dropped_records'])
+    assert 0 < report['flushed_bytes']
+    assert 0 == report['dropped_bytes']
+
+
+@pytest.mark.asyncio
+async def test_aclose_counts_records_sent_while_waiting(mock_server):
+    aiofluent.handler.FluentHandler._queue_task = None
+    handler = aiofluent.handler.FluentHandler(
+        'app.follow', connection_factory=mock_server.factory, batch_size=3)
+    handler.setFormatter(aiofluent.handler.FluentRecordFormatter())
+    log = logging.getLogger('fluent.test.aclose')
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.handlers = [handler]
+    for idx in range(10):
+        log.info({'idx': idx})
+
+    # the consumer sends the records, not the closing sender
+    report = await handler.aclose(timeout=1)
+    assert list(range(10)) == [e[2]['idx'] for e in mock_server.get_events()]
+    assert (10, 0) == (report['flushed_records'], report['dropped_records'])
+    assert len(mock_server._buf.getvalue()) == report['flushed_bytes']
+    aiofluent.handler.FluentHandler._queue_task = None
+
+
+@pytest.mark.asyncio
+async def test_aclose_drops_records_at_deadline(mock_server):
+    handler = _overflow_handler(mock_server, queue_size=3)
+    for idx in range(3):
+        handler.emit(_record(str(idx)))
+
+    # no consumer is running
+    report = await handler.aclose(timeout=0.01)
+    assert (0, 3) == (report['flushed_records'], report['dropped_records'])
+    assert 0 == handler.qsize()
+    aiofluent.handler.FluentHandler._queue_task = None
+
+
+@pytest.mark.asyncio
+async def test_aclose_keeps_consumer_of_other_handlers():
+    aiofluent.handler.FluentHandler._queue_task = None
+    async with StubFluentd() as server:
+        logs = []
+        for name in ('one', 'two'):
+            handler = aiofluent.handler.FluentHandler(
+                'app.' + name, port=server.port)
+            handler.setFormatter(aiofluent.handler.FluentRecordFormatter())
+            log = logging.getLogger('fluent.test.' + name)
+            log.propagate = False
+            log.setLevel(logging.INFO)
+            log.handlers = [handler]
+            logs.append(log)
+        one, two = logs
+        two.info({'idx': 0})
+        one.info({'idx': 1})
+        await one.handlers[0].aclose(timeout=1)
+        # the queue consumer still runs for the other handler
+        two.info({'idx': 2})
+        two.info({'idx': 3})
+        await server.wait_for_events(4, timeout=1)
+        report = await two.handlers[0].aclose(timeout=1)
+    assert [0, 1, 2, 3] == [e[2]['idx'] for e in server.events]
+    assert not two.handlers[0].dropped
+    # sent before aclose, nothing was left to flush
+    assert 0 == report['flushed_records'] == report['flushed_bytes']
+    assert aiofluent.handler.FluentHandler._queue_task.done()
+    aiofluent.handler.FluentHandler._queue_task = None
+
+
+@pytest.mark.asyncio
+async def test_threaded_handler_aclose(mock_server):
+    handler = aiofluent.handler.ThreadedFluentHandler(
+        'app.follow', connection_factory=mock_server.factory,
+        packed_forward=True, flush_interval=60)
+    handler.setFormatter(aiofluent.handler.FluentRecordFormatter())
+    log = logging.getLogger('fluent.test.aclose')
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.handlers = [handler]
+    for idx in range(20):
+        log.info({'idx': idx})
+
+    report = await handler.aclose(timeout=1)
+    assert list(range(20)) == [e[2]['idx'] for e in mock_server.get_events()]
+    assert (20, 0) == (report['flushed_records'], report['dropped_records'])
+    assert 0 < report['flushed_bytes']
+    assert not handler._thread.is_alive()
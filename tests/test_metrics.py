@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from aiofluent import metrics
+import aiofluent.handler
+import aiofluent.sender
+import asyncio
+import logging
+import pytest
+
+
+def test_histogram():
+    histogram = metrics.Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    assert {
+        'count': 4,
+        'sum': 2.65,
+        'buckets': {'0.1': 2, '1.0': 1, '+Inf': 1},
+    } == histogram.snapshot()
+
+
+@pytest.mark.asyncio
+async def test_sender_metrics(mock_sender, mock_server):
+    await mock_sender.async_emit('foo', {'bar': 'baz'})
+    await mock_sender.async_emit_batch('foo', [(None, {'a': 1}), (None, {'b': 2})])
+    snapshot = mock_sender.metrics.snapshot()
+    assert 3 == snapshot['counters']['events']
+    assert len(mock_server._buf.getvalue()) == snapshot['counters']['bytes_written']
+    assert {'pending_size': 0, 'inflight': 0} == snapshot['gauges']
+    assert 2 == snapshot['histograms']['drain_seconds']['count']
+    assert 2 == snapshot['histograms']['emit_to_write_seconds']['count']
+
+
+@pytest.mark.asyncio
+async def test_sender_failure_metrics(mock_server):
+    connected = []
+
+    async def factory(sender):
+        if connected:
+            return await mock_server.factory(sender)
+        connected.append(True)
+
+    sender = aiofluent.sender.FluentSender(
+        'test', connection_factory=factory, retry_timeout=0)
+    assert not await sender.async_emit('foo', {'bar': 'baz'})
+    assert await sender.async_emit('foo', {'bar': 'baz'})
+    sender._close_connection()
+    # buffered, and sent by the reconnect task
+    assert not await sender.async_emit('foo', {'bar': 'baz'})
+    while sender._writer is None:
+        await asyncio.sleep(0.01)
+    sender.close()
+    counters = sender.metrics.snapshot()['counters']
+    assert 2 == counters['send_failures']
+    assert 1 == counters['connect_failures']
+    assert 1 == counters['reconnects']
+    assert 3 == len(mock_server.get_events())
+
+
+@pytest.mark.asyncio
+async def test_sender_overflow_metrics():
+    async def factory(sender):
+        return None
+
+    sender = aiofluent.sender.FluentSender(
+        'test', connection_factory=factory, bufmax=10)
+    assert not await sender.async_emit('foo', {'bar': 'baz'})
+    sender.close()
+    assert sender.metrics.counters['overflow_bytes'] > 10
+
+
+@pytest.mark.asyncio
+async def test_periodic_report(mock_server):
+    snapshots = []
+    sender = aiofluent.sender.FluentSender(
+        'test', connection_factory=mock_server.factory,
+        metrics_interval=0.01, metrics_callback=snapshots.append)
+    await sender.async_emit('foo', {'bar': 'baz'})
+    for _ in range(100):
+        if len(mock_server.get_events()) > 1:
+            break
+        await asyncio.sleep(0.01)
+    task = sender._metrics_task
+    sender.close()
+    await asyncio.gather(task, return_exceptions=True)
+
+    assert 1 == snapshots[0]['counters']['events']
+    events = mock_server.get_events()
+    assert 'test.aiofluent.metrics' == events[1][0]
+    assert 1 == events[1][2]['counters']['events']
+
+
+class PendingTask:
+
+    def done(self):
+        return False
+
+
+@pytest.mark.asyncio
+async def test_handler_metrics(mock_server):
+    handler = aiofluent.handler.FluentHandler(
+        'app.follow', connection_factory=mock_server.factory)
+    aiofluent.handler.FluentHandler._queue_task = PendingTask()
+    aiofluent.handler.FluentHandler._queue = aiofluent.handler.LogQueue(
+        maxsize=1)
+    record = logging.LogRecord(
+        'fluent.test', logging.DEBUG, __file__, 1, 'hello', None, None)
+    handler.emit(record)
+    handler.emit(record)
+    snapshot = handler.sender.metrics.snapshot()
+    assert 1 == snapshot['gauges']['queue_size']
+    assert 1 == snapshot['counters']['queue_full_drops.DEBUG']
+    aiofluent.handler.FluentHandler._queue_task = None
+    aiofluent.handler.FluentHandler._queue = None
+    handler.sender.close()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from aiofluent.testing import StubFluentd
+from tests.mockserver import MockRecvServer
+
+import aiofluent.pool
+import aiofluent.sender
+import asyncio
+import pytest
+
+
+def _pool(servers, **kwargs):
+    endpoints = kwargs.pop('endpoints', [
+        ('host{}'.format(idx), 24224) for idx in range(len(servers))])
+    factories = {
+        'host{}'.format(idx): server for idx, server in enumerate(servers)}
+
+    async def factory(sender):
+        return await factories[sender._host].factory(sender)
+
+    return aiofluent.pool.FluentSenderPool(
+        'test', endpoints, connection_factory=factory, **kwargs)
+
+
+def test_endpoints():
+    pool = aiofluent.pool.FluentSenderPool(
+        'test', ['host1:24224', ('host2', 24225), ('host3', 24226, 3)])
+    assert [('host1', 24224), ('host2', 24225), ('host3', 24226)] == [
+        (s._host, s._port) for s in pool.senders]
+    assert [1, 1, 3] == pool._weights
+    with pytest.raises(ValueError):
+        aiofluent.pool.FluentSenderPool('test', ['host1:24224'], strategy='x')
+
+
+def test_weighted_round_robin():
+    pool = aiofluent.pool.FluentSenderPool(
+        'test', [('host1', 24224, 1), ('host2', 24224, 3)])
+    hosts = [pool.select()._host for _ in range(8)]
+    assert 2 == hosts.count('host1')
+    assert 6 == hosts.count('host2')
+    # smooth, host1 is not starved in a row
+    assert 'host1' in hosts[:4]
+
+
+@pytest.mark.asyncio
+async def test_spreads_events():
+    servers = [MockRecvServer(), MockRecvServer()]
+    pool = _pool(servers)
+    for idx in range(4):
+        assert await pool.async_emit('foo', {'idx': idx})
+    assert [0, 2] == [m[2]['idx'] for m in servers[0].get_recieved()]
+    assert [1, 3] == [m[2]['idx'] for m in servers[1].get_recieved()]
+    pool.close()
+
+
+@pytest.mark.asyncio
+async def test_least_pending():
+    servers = [MockRecvServer(), MockRecvServer()]
+    pool = _pool(servers, strategy='least_pending', packed_forward=True)
+    await pool.async_emit('foo', {'data': 'x' * 100})
+    await pool.async_emit('foo', {'data': 'x'})
+    await pool.async_emit('foo', {'data': 'x'})
+    assert pool.senders[0].pending_size > pool.senders[1].pending_size
+    await pool.flush()
+    assert 0 == pool.senders[1].pending_size
+    pool.close()
+    # let the flush tasks see their cancellation
+    await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_failover_moves_backlog():
+    servers = [MockRecvServer(), MockRecvServer()]
+
+    def broken(data):
+        raise OSError('connection reset')
+
+    servers[0]._writer.write = broken
+    pool = _pool(servers)
+    # goes to the first endpoint, fails and is moved to the second one
+    assert await pool.async_emit('foo', {'idx': 0})
+    assert not pool.senders[0].healthy
+    assert 0 == len(pool.senders[0]._pendings)
+    # the broken endpoint is skipped
+    assert await pool.async_emit('foo', {'idx': 1})
+    assert [0, 1] == [m[2]['idx'] for m in servers[1].get_recieved()]
+    pool.close()
+
+
+@pytest.mark.asyncio
+async def test_failover_moves_unacked_frames():
+    async with StubFluentd(ack=True) as down, StubFluentd(ack=True) as up:
+        down.refuse()
+        pool = aiofluent.pool.FluentSenderPool(
+            'test', [('127.0.0.1', down.port), ('127.0.0.1', up.port)],
+            require_ack=True, reconnect_delay=60)
+        await pool.async_emit('foo', {'idx': 0})
+        assert not pool.senders[0].healthy
+        # the frame waiting for its ack went to the other endpoint
+        assert not pool.senders[0]._inflight
+        assert 0 == pool.senders[0].pending_size
+        await pool.async_emit('foo', {'idx': 1})
+        events = await up.wait_for_events(2)
+        assert [0, 1] == [e[2]['idx'] for e in events]
+        pool.close()
+
+
+def test_pending_size_counts_unacked_frames():
+    sender = aiofluent.sender.FluentSender('test', require_ack=True)
+    sender._inflight['a'] = b'x' * 10
+    sender._add_waiting('b', b'y' * 5)
+    assert 15 == sender.pending_size
+    sender.close()
+
+
+@pytest.mark.asyncio
+async def test_all_endpoints_down():
+    servers = [MockRecvServer(), MockRecvServer()]
+
+    def broken(data):
+        raise OSError('connection reset')
+
+    for server in servers:
+        server._writer.write = broken
+    pool = _pool(servers)
+    assert not await pool.async_emit('foo', {'idx': 0})
+    assert not await pool.async_emit('foo', {'idx': 1})
+    assert pool.last_error is not None
+    assert 2 == sum(len(s._pendings.chunks) for s in pool.senders)
+    pool.close()
+
+
+def test_tag_hash():
+    pool = aiofluent.pool.FluentSenderPool(
+        'test', ['host1:24224', 'host2:24224', 'host3:24224'],
+        strategy='tag_hash')
+    for label in ('foo', 'bar', 'baz', None):
+        assert pool.select(label) is pool.select(label)
+    # skips an unhealthy sender
+    sender = pool.select('foo')
+    sender._backoff()
+    assert pool.select('foo') is not sender
+    assert pool.select('foo').healthy
+
+
+@pytest.mark.asyncio
+async def test_sharded_sender():
+    server = MockRecvServer()
+    msender = aiofluent.pool.ShardedFluentSender(
+        'test', connections=3, connection_factory=server.factory)
+    assert 3 == len(msender.senders)
+    for idx in range(6):
+        await msender.async_emit('foo', {'idx': idx})
+        await msender.async_emit('bar', {'idx': idx})
+    # one connection per label in use, events of a label kept in order
+    assert server.connections <= 2
+    data = server.get_recieved()
+    assert list(range(6)) == [m[2]['idx'] for m in data if m[0] == 'test.foo']
+    msender.close()
+
+    msender = aiofluent.pool.ShardedFluentSender(
+        'test', connections=3, shard_by='round_robin',
+        connection_factory=server.factory)
+    for idx in range(3):
+        await msender.async_emit('foo', {'idx': idx})
+    assert all(s._writer is not None for s in msender.senders)
+    msender.close()
+
+    with pytest.raises(ValueError):
+        aiofluent.pool.ShardedFluentSender('test', shard_by='x')
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from aiofluent.ratelimit import RateLimiter, Rule
+from unittest.mock import patch
+import aiofluent.handler
+import aiofluent.sender
+import logging
+import pytest
+
+
+def test_rule_matches():
+    rule = Rule(tag='app.*', logger='app.db', level='DEBUG')
+    assert rule.matches('app.follow', None, 'app.db', logging.DEBUG)
+    assert rule.matches('app.follow', None, 'app.db.pool', logging.DEBUG)
+    assert not rule.matches('other', None, 'app.db', logging.DEBUG)
+    assert not rule.matches('app.follow', None, 'app.dbx', logging.DEBUG)
+    assert not rule.matches('app.follow', None, 'app.db', logging.INFO)
+    assert not rule.matches('app.follow', None, None, None)
+    assert 'tag=app.*,logger=app.db,level=10' == rule.name
+
+
+def test_token_bucket():
+    limiter = RateLimiter([Rule(label='noisy', rate=2)])
+    with patch('aiofluent.ratelimit.time.monotonic', return_value=1000.0):
+        limiter.rules[0]._updated = 1000.0
+        assert [True, True, False] == [
+            limiter.allow(label='noisy') for _ in range(3)]
+        # other labels are not limited
+        assert limiter.allow(label='quiet')
+    with patch('aiofluent.ratelimit.time.monotonic', return_value=1000.5):
+        assert [True, False] == [limiter.allow(label='noisy') for _ in range(2)]
+    assert {'label=noisy': 2} == limiter.dropped
+
+
+def test_sampling():
+    limiter = RateLimiter([Rule(level=logging.DEBUG, sample=0.25)])
+    with patch('aiofluent.ratelimit.random.random', side_effect=[0.1, 0.5, 0.3]):
+        assert [True, False, False] == [
+            limiter.allow(level=logging.DEBUG) for _ in range(3)]
+
+
+def test_first_matching_rule_decides():
+    limiter = RateLimiter([
+        Rule(logger='app.audit'),
+        Rule(logger='app', sample=0),
+    ])
+    assert limiter.allow(logger='app.audit')
+    assert not limiter.allow(logger='app.web')
+
+
+@pytest.mark.asyncio
+async def test_sender_rate_limits(mock_server):
+    sender = aiofluent.sender.FluentSender(
+        'test', connection_factory=mock_server.factory,
+        rate_limits=[Rule(tag='test.noisy', sample=0)])
+    with patch.object(sender, '_make_packet', wraps=sender._make_packet) as pack:
+        assert await sender.async_emit('noisy', {'a': 1})
+        assert await sender.async_emit('follow', {'a': 2})
+        assert 1 == pack.call_count
+    assert await sender.async_emit_batch('noisy', [(None, {'a': 3})])
+    sender.close()
+
+    assert [('test.follow', {'a': 2})] == [
+        (e[0], e[2]) for e in mock_server.get_events()]
+    assert 2 == sender.metrics.counters['sampled_out']
+
+
+def test_handler_rate_limits(mock_server):
+    handler = aiofluent.handler.ThreadedFluentHandler(
+        'app.follow', connection_factory=mock_server.factory,
+        rate_limits=[Rule(level='DEBUG', sample=0)])
+    formatter = aiofluent.handler.FluentRecordFormatter()
+    handler.setFormatter(formatter)
+    log = logging.getLogger('fluent.test.ratelimit')
+    log.propagate = False
+    log.setLevel(logging.DEBUG)
+    log.handlers = [handler]
+    with patch.object(formatter, 'format', wraps=formatter.format) as format:
+        log.debug('dropped')
+        log.info('kept')
+        handler.close()
+        assert 1 == format.call_count
+
+    assert ['kept'] == [e[2]['message'] for e in mock_server.get_events()]
+    assert {'level=10': 1} == handler.limiter.dropped
+    assert 1 == handler.sender.metrics.counters['sampled_out']
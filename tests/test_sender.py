@@ -1,7 +1,17 @@
 # -*- coding: utf-8 -*-
+from io import BytesIO
+from aiofluent.testing import StubFluentd
+
 import aiofluent.sender
+import asyncio
+import gzip
+import msgpack
+import os
 import pytest
 import socket
+import time
+
+from tests.mockserver import MockRecvServer
 
 
 def test_no_kwargs():
@@ -68,3 +78,573 @@ def test_clear_last_error(mock_sender, mock_server):
     mock_sender.last_error = socket.error(EXCEPTION_MSG)
     mock_sender.clear_last_error()
     assert mock_sender.last_error is None
+
+
+def _unpack_entries(entries):
+    return list(msgpack.Unpacker(BytesIO(entries), encoding='utf-8'))
+
+
+@pytest.mark.asyncio
+async def test_packed_forward(mock_server):
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=mock_server.factory,
+        packed_forward=True)
+    await msender.async_emit('foo', {'bar': 'baz'})
+    await msender.async_emit('foo', {'bar': 'qux'})
+    await msender.async_emit('other', {'bar': 'baz'})
+    # nothing sent until flushed
+    assert mock_server.get_recieved() == []
+    assert await msender.flush()
+    data = mock_server.get_recieved()
+    assert 2 == len(data)
+    tag, entries, option = data[0]
+    assert 'test.foo' == tag
+    assert {'size': 2} == option
+    records = _unpack_entries(entries)
+    assert [{'bar': 'baz'}, {'bar': 'qux'}] == [r[1] for r in records]
+    assert 'test.other' == data[1][0]
+    msender.close()
+    # let the flush task see its cancellation
+    await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_packed_forward_size_limit(mock_server):
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=mock_server.factory,
+        packed_forward=True, max_batch_size=50)
+    for idx in range(10):
+        await msender.async_emit('foo', {'idx': idx})
+    data = mock_server.get_recieved()
+    assert len(data) >= 1
+    assert all(len(frame[1]) >= 50 for frame in data)
+    await msender.flush()
+    data = mock_server.get_recieved()
+    records = []
+    for frame in data:
+        records.extend(_unpack_entries(frame[1]))
+    assert list(range(10)) == [r[1]['idx'] for r in records]
+    msender.close()
+
+
+@pytest.mark.asyncio
+async def test_packed_forward_flush_interval(mock_server):
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=mock_server.factory,
+        packed_forward=True, flush_interval=0.01)
+    await msender.async_emit('foo', {'bar': 'baz'})
+    await asyncio.sleep(0.05)
+    data = mock_server.get_recieved()
+    assert 1 == len(data)
+    assert 'test.foo' == data[0][0]
+    assert msender._flush_task.done()
+    msender.close()
+
+
+@pytest.mark.asyncio
+async def test_compressed_packed_forward(mock_server):
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=mock_server.factory,
+        compressed='gzip')
+    await msender.async_emit('foo', {'bar': 'baz'})
+    await msender.async_emit('foo', {'bar': 'qux'})
+    await msender.flush()
+    data = mock_server.get_recieved()
+    assert 1 == len(data)
+    tag, entries, option = data[0]
+    assert 'test.foo' == tag
+    assert {'size': 2, 'compressed': 'gzip'} == option
+    records = _unpack_entries(gzip.decompress(entries))
+    assert [{'bar': 'baz'}, {'bar': 'qux'}] == [r[1] for r in records]
+    msender.close()
+
+
+@pytest.mark.asyncio
+async def test_compressed_in_executor_keeps_order(mock_server):
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=mock_server.factory,
+        compressed='gzip', max_batch_size=100, compress_threshold=200)
+    for idx in range(50):
+        await msender.async_emit('foo', {'idx': idx, 'pad': 'x' * idx})
+    await msender.flush()
+    records = []
+    for frame in mock_server.get_recieved():
+        records.extend(_unpack_entries(gzip.decompress(frame[1])))
+    assert list(range(50)) == [r[1]['idx'] for r in records]
+    msender.close()
+
+
+def test_unsupported_compression():
+    with pytest.raises(ValueError):
+        aiofluent.sender.FluentSender(tag='test', compressed='zstd')
+
+
+@pytest.mark.asyncio
+async def test_require_ack():
+    server = MockRecvServer(ack=True)
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=server.factory, require_ack=True)
+    assert await msender.async_emit('foo', {'bar': 'baz'})
+    await asyncio.sleep(0)
+    data = server.get_recieved()
+    assert 1 == len(data)
+    assert 4 == len(data[0])
+    assert 'chunk' in data[0][3]
+    assert not msender._inflight
+    msender.close()
+
+
+@pytest.mark.asyncio
+async def test_require_ack_packed_forward():
+    server = MockRecvServer(ack=True)
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=server.factory, require_ack=True,
+        packed_forward=True)
+    await msender.async_emit('foo', {'bar': 'baz'})
+    await msender.flush()
+    await asyncio.sleep(0)
+    option = server.get_recieved()[0][2]
+    assert 1 == option['size']
+    assert 'chunk' in option
+    assert not msender._inflight
+    msender.close()
+
+
+@pytest.mark.asyncio
+async def test_unacked_chunks_resent_after_reconnect():
+    server = MockRecvServer(ack=True)
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=server.factory, require_ack=True,
+        reconnect_delay=0.01)
+    server.ack = False
+    await msender.async_emit('foo', {'idx': 1})
+    await msender.async_emit('foo', {'idx': 2})
+    assert 2 == len(msender._inflight)
+
+    # fluentd goes away without acking
+    server._reader.feed_eof()
+    await asyncio.sleep(0)
+    assert msender._writer is None
+
+    server.ack = True
+    # connecting is on hold, the event waits for the reconnect task
+    assert not await msender.async_emit('foo', {'idx': 3})
+    await _wait_for(lambda: not msender._inflight)
+    assert 2 == server.connections
+    assert [1, 2, 1, 2, 3] == [m[2]['idx'] for m in server.get_recieved()]
+    assert not msender._inflight
+    msender.close()
+
+
+@pytest.mark.asyncio
+async def test_ack_window_is_bounded():
+    server = MockRecvServer(ack=True)
+    overflow = []
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=server.factory, require_ack=True,
+        ack_window=2, ack_timeout=0.01, bufmax=100,
+        buffer_overflow_handler=overflow.append)
+    server.ack = False
+    assert await msender.async_emit('foo', {'idx': 1})
+    assert await msender.async_emit('foo', {'idx': 2})
+    # kept until the window has room again
+    assert await msender.async_emit('foo', {'idx': 3})
+    assert 2 == len(msender._inflight)
+    assert 1 == len(msender._waiting)
+    assert isinstance(msender.last_error, asyncio.TimeoutError)
+    assert not overflow
+
+    # only frames over `bufmax` overflow
+    assert not await msender.async_emit('foo', {'blob': 'x' * 100})
+    assert 1 == len(overflow)
+    assert 1 == len(msender._waiting)
+    msender.close()
+
+
+@pytest.mark.asyncio
+async def test_emits_past_the_ack_window_succeed():
+    async with StubFluentd(ack=True, ack_delay=0.01) as server:
+        msender = aiofluent.sender.FluentSender(
+            'test', port=server.port, require_ack=True, ack_window=2)
+        results = await asyncio.gather(
+            *[msender.async_emit('foo', {'idx': idx}) for idx in range(20)])
+        # frames waiting for the window are accepted as well
+        assert all(results)
+        await server.wait_for_events(20)
+        await msender.aclose(timeout=1)
+    assert list(range(20)) == [e[2]['idx'] for e in server.events]
+
+
+@pytest.mark.asyncio
+async def test_nonblocking_emit(mock_server):
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=mock_server.factory,
+        nonblocking=True, flush_interval=0.01)
+    assert await msender.async_emit('foo', {'idx': 1})
+    assert await msender.async_emit('foo', {'idx': 2})
+    # emit did not touch the connection
+    assert 0 == mock_server.connections
+    await asyncio.sleep(0.05)
+    assert 1 == mock_server.connections
+    assert [1, 2] == [m[2]['idx'] for m in mock_server.get_recieved()]
+    assert 0 == msender._buffered
+    msender.close()
+
+
+@pytest.mark.asyncio
+async def test_nonblocking_flushes_on_size(mock_server):
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=mock_server.factory,
+        nonblocking=True, packed_forward=True, max_batch_size=50,
+        flush_interval=10)
+    for idx in range(10):
+        await msender.async_emit('foo', {'idx': idx})
+    await asyncio.sleep(0.01)
+    records = []
+    for frame in mock_server.get_recieved():
+        records.extend(_unpack_entries(frame[1]))
+    assert list(range(10)) == [r[1]['idx'] for r in records]
+    msender.close()
+
+
+@pytest.mark.asyncio
+async def test_nonblocking_buffer_is_bounded(mock_server):
+    overflow = []
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=mock_server.factory,
+        nonblocking=True, bufmax=50, max_batch_size=1000,
+        buffer_overflow_handler=overflow.append)
+    for idx in range(10):
+        await msender.async_emit('foo', {'idx': idx})
+    assert overflow
+    assert msender._buffered >= 50
+    await msender.flush()
+    assert 0 == msender._buffered
+    msender.close()
+
+
+async def _wait_for(predicate):
+    for _ in range(100):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_pendings_sent_after_reconnect(mock_server):
+    available = False
+
+    async def factory(sender):
+        if available:
+            return await mock_server.factory(sender)
+
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=factory, reconnect_delay=0.01)
+    for idx in range(3):
+        assert not await msender.async_emit('foo', {'idx': idx})
+    assert 3 == len(msender._pendings.chunks)
+    assert len(msender._pendings) == len(msender._pendings.getvalue())
+
+    # sent by the reconnect task, without waiting for another event
+    available = True
+    await _wait_for(lambda: not msender._pendings)
+    assert [0, 1, 2] == [m[2]['idx'] for m in mock_server.get_recieved()]
+    assert await msender.async_emit('foo', {'idx': 3})
+    assert 3 == mock_server.get_recieved()[-1][2]['idx']
+    msender.close()
+
+
+@pytest.mark.asyncio
+async def test_reconnect_backoff():
+    attempts = []
+
+    async def factory(sender):
+        attempts.append(time.monotonic())
+
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=factory, reconnect_delay=0.01,
+        retry_timeout=0.04)
+    assert not await msender.async_emit('foo', {'idx': 0})
+    assert not msender.healthy
+    # on hold, the event is buffered without trying to connect
+    assert not await msender.async_emit('foo', {'idx': 1})
+    await asyncio.sleep(0.2)
+    msender.close()
+
+    delays = [b - a for a, b in zip(attempts, attempts[1:])]
+    # half of the delay is random, it doubles up to `retry_timeout`
+    assert 0.005 <= delays[0] < 0.02
+    assert 0.01 <= delays[1]
+    assert all(delay < 0.06 for delay in delays)
+    assert len(attempts) == msender.metrics.counters['connect_failures']
+
+
+@pytest.mark.asyncio
+async def test_emit_does_not_wait_for_reconnect(mock_server):
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=mock_server.factory)
+    assert await msender.async_emit('foo', {'idx': 0})
+
+    connecting = asyncio.Event()
+
+    async def slow_factory(sender):
+        connecting.set()
+        await asyncio.sleep(60)
+
+    msender._connection_factory = slow_factory
+    # fluentd closed the connection, the reader notices it
+    mock_server._reader.feed_eof()
+    await asyncio.sleep(0)
+    assert msender._writer is None
+    msender._reconnect_at = 0
+    assert not await asyncio.wait_for(
+        msender.async_emit('foo', {'idx': 1}), 0.1)
+    await connecting.wait()
+    # the reconnect task is connecting, events are buffered meanwhile
+    assert not await asyncio.wait_for(
+        msender.async_emit('foo', {'idx': 2}), 0.1)
+    assert 2 == len(msender._pendings.chunks)
+    msender.close()
+
+
+class _StalledWriter(object):
+    """Writer whose drains wait until `fail` fails them, oldest first"""
+
+    def __init__(self):
+        self.drains = []
+
+    def writelines(self, chunks):
+        pass
+
+    async def drain(self):
+        drain = asyncio.get_event_loop().create_future()
+        self.drains.append(drain)
+        await drain
+
+    def fail(self):
+        for drain in self.drains:
+            drain.set_exception(ConnectionResetError())
+
+    def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_concurrent_failed_sends_keep_order():
+    writer = _StalledWriter()
+
+    async def factory(sender):
+        return None, writer
+
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=factory, reconnect_delay=60)
+    assert await msender.connect()
+    first = asyncio.ensure_future(msender.async_emit('foo', {'idx': 1}))
+    await _wait_for(lambda: 1 == len(writer.drains))
+    second = asyncio.ensure_future(msender.async_emit('foo', {'idx': 2}))
+    await _wait_for(lambda: 2 == len(writer.drains))
+    writer.fail()
+    assert [False, False] == await asyncio.gather(first, second)
+
+    events = msgpack.Unpacker(BytesIO(msender._pendings.getvalue()), raw=False)
+    assert [1, 2] == [e[2]['idx'] for e in events]
+    # the lost connection was only handled once
+    assert 1 == msender._reconnect_attempts
+    msender.close()
+
+
+@pytest.mark.asyncio
+async def test_pendings_overflow():
+    overflow = []
+
+    async def factory(sender):
+        return None
+
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=factory, bufmax=100,
+        buffer_overflow_handler=overflow.append)
+    for idx in range(10):
+        await msender.async_emit('foo', {'idx': idx})
+    assert overflow
+    assert len(msender._pendings) <= 100
+    overflow.append(msender._pendings.getvalue())
+    events = list(msgpack.Unpacker(
+        BytesIO(b''.join(overflow)), encoding='utf-8'))
+    assert list(range(10)) == [m[2]['idx'] for m in events]
+    msender.close()
+
+
+def test_make_packet_matches_packb(mock_sender):
+    packet = mock_sender._make_packet('foo', msgpack.packb(123), {'bar': 'baz'})
+    assert msgpack.packb(('test.foo', 123, {'bar': 'baz'})) == packet
+    packet = mock_sender._make_packet(
+        None, msgpack.packb(123), {'bar': 'baz'}, {'chunk': 'x'})
+    assert msgpack.packb(
+        ('test', 123, {'bar': 'baz'}, {'chunk': 'x'})) == packet
+
+
+def test_packed_tag_is_cached(mock_sender):
+    for _ in range(3):
+        mock_sender._make_packet('foo', msgpack.packb(123), {'bar': 'baz'})
+    info = mock_sender._packed_tag.cache_info()
+    assert 1 == info.misses
+    assert 2 == info.hits
+
+
+@pytest.mark.parametrize('size', [10, 300, 70000])
+def test_make_frame_bin_header(mock_sender, size):
+    entries = bytearray(b'x' * size)
+    frame = mock_sender._make_frame('foo', entries, {'size': 1})
+    assert msgpack.packb(
+        ('test.foo', bytes(entries), {'size': 1}), use_bin_type=True) == frame
+
+
+def test_packed_event_time():
+    expected = msgpack.packb(aiofluent.sender.EventTime(1500000000.25))
+    assert expected == aiofluent.sender._pack_event_time(1500000000.25)
+    assert expected == aiofluent.sender._pack_event_time_ns(
+        1500000000250000000)
+
+
+@pytest.mark.asyncio
+async def test_nanosecond_precision(mock_sender, mock_server):
+    await mock_sender.async_emit('foo', {'bar': 'baz'})
+    await mock_sender.async_emit_with_time('foo', 1500000000.5, {'bar': 'baz'})
+    data = mock_server.get_recieved()
+    assert isinstance(data[0][1], msgpack.ExtType)
+    assert 0 == data[0][1].code
+    assert msgpack.ExtType(0, b'\x59\x68\x2f\x00\x1d\xcd\x65\x00') == data[1][1]
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(
+    not hasattr(asyncio, 'start_unix_server'), reason='no unix sockets')
+async def test_unix_socket(tmpdir):
+    path = str(tmpdir.join('fluent.sock'))
+    received = []
+
+    async def handle(reader, writer):
+        received.append(await reader.read())
+        writer.close()
+
+    server = await asyncio.start_unix_server(handle, path)
+    msender = aiofluent.sender.FluentSender(
+        tag='test', host='unix://' + path)
+    assert await msender.async_emit('foo', {'bar': 'baz'})
+    msender.close()
+    for _ in range(100):
+        if received:
+            break
+        await asyncio.sleep(0.01)
+    server.close()
+    data = list(msgpack.Unpacker(BytesIO(received[0]), raw=False))
+    assert 'test.foo' == data[0][0]
+    assert {'bar': 'baz'} == data[0][2]
+
+
+@pytest.mark.asyncio
+async def test_emit_batch(mock_sender, mock_server):
+    assert await mock_sender.async_emit_batch(
+        'foo', [(1, {'idx': 1}), (2, {'idx': 2})])
+    assert await mock_sender.async_emit_batch('foo', [(3, {'idx': 3})])
+    data = mock_server.get_recieved()
+    # several events go out as one PackedForward frame
+    assert {'size': 2} == data[0][2]
+    assert 3 == len(data[1])
+    events = mock_server.get_events()
+    assert [1, 2, 3] == [e[2]['idx'] for e in events]
+
+
+@pytest.mark.parametrize('size', [1, 12, 15, 20])
+def test_static_fields_spliced(size):
+    sender = aiofluent.sender.FluentSender(
+        'test', static_fields={'host': 'web1', 'region': 'eu', 'v': 2})
+    record = {'k{}'.format(idx): idx for idx in range(size)}
+    packed = sender._pack_record(record)
+    assert dict(record, host='web1', region='eu', v=2) == msgpack.unpackb(
+        packed, raw=False)
+    # strings are sent as they are
+    assert msgpack.packb('text') == sender._pack_record('text')
+
+
+@pytest.mark.asyncio
+async def test_static_fields(mock_server):
+    sender = aiofluent.sender.FluentSender(
+        'test', connection_factory=mock_server.factory,
+        static_fields={'service': 'api', 'region': 'eu'})
+    await sender.async_emit('foo', {'bar': 'baz', 'region': 'us'})
+    sender._packed_forward = True
+    await sender.async_emit('foo', {'bar': 'qux'})
+    await sender.flush()
+    sender.close()
+
+    events = mock_server.get_events()
+    # fields of the record win over static ones
+    assert {'service': 'api', 'region': 'us', 'bar': 'baz'} == events[0][2]
+    assert {'service': 'api', 'region': 'eu', 'bar': 'qux'} == events[1][2]
+
+
+def test_reset_after_fork(mock_sender):
+    mock_sender._writer = object()
+    mock_sender._pendings.append(b'parent')
+    pid = os.fork()
+    if pid == 0:
+        # the child neither reuses the socket nor sends what the parent had
+        ok = mock_sender._writer is None and not len(mock_sender._pendings)
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert 0 == status
+    assert mock_sender._writer is not None
+    assert 6 == len(mock_sender._pendings)
+    mock_sender._writer = None
+
+
+@pytest.mark.asyncio
+async def test_aclose_flushes_buffers(mock_server):
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=mock_server.factory,
+        nonblocking=True, packed_forward=True, flush_interval=60)
+    for idx in range(3):
+        await msender.async_emit('foo', {'idx': idx})
+    assert 0 == mock_server.connections
+
+    report = await msender.aclose(timeout=1)
+    assert [0, 1, 2] == [e[2]['idx'] for e in mock_server.get_events()]
+    assert 0 < report['flushed_bytes']
+    assert 0 == report['spilled_bytes'] == report['dropped_bytes']
+    # no new events once closing
+    assert not await msender.async_emit('foo', {'idx': 3})
+    assert not await msender.async_emit_batch('foo', [(None, {'idx': 4})])
+    assert 3 == len(mock_server.get_events())
+
+
+async def _refused(sender):
+    sender.last_error = ConnectionRefusedError()
+
+
+@pytest.mark.asyncio
+async def test_aclose_drops_at_deadline():
+    overflow = []
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=_refused, packed_forward=True,
+        flush_interval=60, buffer_overflow_handler=overflow.append)
+    await msender.async_emit('foo', {'idx': 1})
+    await msender.async_emit('bar', {'idx': 2})
+
+    report = await msender.aclose(timeout=0.05)
+    assert 0 == report['flushed_bytes']
+    assert len(overflow[0]) == report['dropped_bytes']
+    events = list(msgpack.Unpacker(BytesIO(overflow[0]), raw=False))
+    assert ['test.foo', 'test.bar'] == [e[0] for e in events]
+    assert not msender._batches and not msender.pending_size
+
+
+@pytest.mark.asyncio
+async def test_aclose_spills_at_deadline(tmpdir):
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=_refused, spill_dir=str(tmpdir))
+    assert not await msender.async_emit('foo', {'idx': 1})
+    report = await msender.aclose(timeout=0.05)
+    assert 0 < report['spilled_bytes']
+    assert 0 == report['dropped_bytes']
+    assert os.listdir(str(tmpdir))
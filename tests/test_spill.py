@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+from msgpack import Unpacker
+
+import aiofluent.sender
+import aiofluent.spill
+import asyncio
+import os
+import pytest
+
+
+def test_append_and_rotate(tmpdir):
+    spill = aiofluent.spill.SpillBuffer(str(tmpdir), segment_size=10)
+    assert spill.append(b'a' * 6)
+    assert spill.append(b'b' * 6)
+    assert spill.append(b'c' * 20)
+    assert 32 == len(spill)
+    # the segment being written is not listed
+    assert 2 == len(spill.segments())
+    spill.seal()
+    segments = spill.segments()
+    assert [b'a' * 6, b'b' * 6, b'c' * 20] == [spill.read(p) for p in segments]
+    spill.remove(segments[0])
+    assert 26 == len(spill)
+
+
+def test_max_size(tmpdir):
+    spill = aiofluent.spill.SpillBuffer(str(tmpdir), max_size=10)
+    assert spill.append(b'a' * 6)
+    assert not spill.append(b'b' * 6)
+    assert 6 == len(spill)
+
+
+def test_segments_survive_a_crash(tmpdir):
+    spill = aiofluent.spill.SpillBuffer(str(tmpdir), segment_size=1024)
+    spill.append(b'abc')
+    spill.append(b'def')
+    # not sealed, the file still has its full mapped size
+    recovered = aiofluent.spill.SpillBuffer(str(tmpdir))
+    assert 6 == len(recovered)
+    assert [b'abcdef'] == [recovered.read(p) for p in recovered.segments()]
+
+
+@pytest.mark.asyncio
+async def test_sender_spills_and_replays(tmpdir, mock_server):
+    available = False
+
+    async def factory(sender):
+        if available:
+            return await mock_server.factory(sender)
+
+    overflow = []
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=factory, bufmax=50,
+        spill_dir=str(tmpdir), buffer_overflow_handler=overflow.append,
+        reconnect_delay=0.01)
+    for idx in range(10):
+        await msender.async_emit('foo', {'idx': idx})
+    assert not overflow
+    assert len(msender._spill) > 0
+
+    # replayed once the reconnect task is connected
+    available = True
+    for _ in range(100):
+        if msender._spill_task is not None:
+            break
+        await asyncio.sleep(0.01)
+    await msender._spill_task
+    await msender.async_emit('foo', {'idx': 10})
+    assert 0 == len(msender._spill)
+    assert [] == os.listdir(str(tmpdir))
+    received = sorted(m[2]['idx'] for m in mock_server.get_recieved())
+    assert list(range(11)) == received
+    msender.close()
+
+
+def _fork(child):
+    pid = os.fork()
+    if pid == 0:
+        ok = False
+        try:
+            ok = child()
+        finally:
+            os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert 0 == status
+    return pid
+
+
+def test_spill_after_fork(tmpdir):
+    msender = aiofluent.sender.FluentSender(
+        tag='test', spill_dir=str(tmpdir), spill_max_size=1024)
+    msender._handle_overflow(b'parent')
+    msender._spill.seal()
+
+    def idle():
+        # nothing is created until the child spills
+        directory = os.path.join(str(tmpdir), str(os.getpid()))
+        return (msender._spill.directory == directory
+                and not os.path.exists(directory))
+
+    def spilling():
+        # the child spills to its own directory, not to the parent's segment
+        msender._handle_overflow(b'child')
+        msender._spill.seal()
+        return (1024 == msender._spill.max_size
+                and [b'child'] == [msender._spill.read(path)
+                                   for path in msender._spill.segments()])
+
+    idle_pid = _fork(idle)
+    pid = _fork(spilling)
+    assert not os.path.exists(os.path.join(str(tmpdir), str(idle_pid)))
+    assert os.path.isdir(os.path.join(str(tmpdir), str(pid)))
+
+    # the child is gone, the parent replays its segments as well
+    assert 11 == msender._spill.refresh()
+    segments = msender._spill.segments()
+    assert [b'parent', b'child'] == [
+        msender._spill.read(path) for path in segments]
+    for path in segments:
+        msender._spill.remove(path)
+    assert 0 == len(msender._spill)
+    assert [] == os.listdir(str(tmpdir))
+    msender.close()
+
+
+def test_segments_of_live_children_are_left_alone(tmpdir):
+    # a directory named after a running process, here this one
+    live = aiofluent.spill.SpillBuffer(
+        os.path.join(str(tmpdir), str(os.getpid())))
+    live.append(b'live')
+    live.seal()
+    spill = aiofluent.spill.SpillBuffer(str(tmpdir))
+    assert 0 == len(spill)
+    assert [] == spill.segments()
+
+
+@pytest.mark.asyncio
+async def test_replay_left_segments(tmpdir, mock_server):
+    spill = aiofluent.spill.SpillBuffer(str(tmpdir))
+    msender = aiofluent.sender.FluentSender(tag='test')
+    spill.append(msender._make_packet('foo', b'\x01', {'idx': 1}))
+    spill.append(msender._make_packet('foo', b'\x02', {'idx': 2}))
+    spill.close()
+
+    msender = aiofluent.sender.FluentSender(
+        tag='test', connection_factory=mock_server.factory,
+        spill_dir=str(tmpdir))
+    assert await msender.replay_spill() > 0
+    data = list(Unpacker(BytesIO(mock_server._buf.getvalue()), raw=False))
+    assert [1, 2] == [m[2]['idx'] for m in data]
+    msender.close()
+
+
+def test_replay_cli_keeps_segments_when_unreachable(tmpdir):
+    spill = aiofluent.spill.SpillBuffer(str(tmpdir))
+    spill.append(b'\x93\xa3tag\x01\x80')
+    spill.close()
+    assert 1 == aiofluent.spill.main(
+        [str(tmpdir), '--port', '1', '--timeout', '0.5'])
+    assert 1 == len(aiofluent.spill.SpillBuffer(str(tmpdir)).segments())
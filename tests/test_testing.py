@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+from aiofluent.testing import StubFluentd
+import aiofluent.sender
+import asyncio
+import msgpack
+import pytest
+import socket
+
+
+@pytest.mark.asyncio
+async def test_decode_modes():
+    async with StubFluentd() as server:
+        for kwargs in ({}, {'packed_forward': True}, {'compressed': 'gzip'}):
+            sender = aiofluent.sender.FluentSender(
+                'test', port=server.port, **kwargs)
+            assert await sender.async_emit('foo', {'mode': len(kwargs)})
+            assert await sender.flush()
+            sender.close()
+
+        # Forward mode
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        writer.write(msgpack.packb(
+            ['test.foo', [[1, {'mode': 'forward'}], [2, {'mode': 'forward'}]]]))
+        await writer.drain()
+        events = await server.wait_for_events(5)
+        writer.close()
+
+    assert ['test.foo'] * 5 == [e[0] for e in events]
+    assert [0, 1, 1, 'forward', 'forward'] == [e[2]['mode'] for e in events]
+    assert isinstance(events[0][1], float)
+    assert {'size': 1, 'compressed': 'gzip'} == server.options[2]
+
+
+@pytest.mark.asyncio
+async def test_delayed_acks():
+    async with StubFluentd(ack=True, ack_delay=0.05) as server:
+        sender = aiofluent.sender.FluentSender(
+            'test', port=server.port, require_ack=True, ack_window=1)
+        assert await sender.async_emit('foo', {'bar': 1})
+        assert 1 == len(sender._inflight)
+        # waits for the first ack before sending
+        assert await sender.async_emit('foo', {'bar': 2})
+        await server.wait_for_events(2)
+        sender.close()
+    assert 'chunk' in server.options[0]
+
+
+@pytest.mark.asyncio
+async def test_reset_mid_stream():
+    async with StubFluentd(reset_after=100) as server:
+        sender = aiofluent.sender.FluentSender(
+            'test', port=server.port, retry_timeout=0)
+        for idx in range(20):
+            await sender.async_emit('foo', {'idx': idx})
+            await asyncio.sleep(0.01)
+        assert 1 <= server.resets
+
+        server.reset_after = None
+        assert await sender.connect()
+        assert await sender.async_emit('foo', {'idx': 20})
+        events = await server.wait_for_events(1)
+        sender.close()
+    assert 1 < server.connections
+    assert 1 <= sender.metrics.counters['reconnects']
+    assert 20 == events[-1][2]['idx']
+
+
+@pytest.mark.asyncio
+async def test_reset_with_full_ack_window():
+    async with StubFluentd(ack=True, ack_delay=0.01) as server:
+        sender = aiofluent.sender.FluentSender(
+            'test', port=server.port, require_ack=True, ack_window=4,
+            reconnect_delay=0.01)
+        for idx in range(20):
+            if idx == 10:
+                server.reset_connections()
+            await sender.async_emit('foo', {'idx': idx})
+        result = await sender.aclose(timeout=5)
+    # acked frames may be received twice, none is missing
+    assert set(range(20)) == {e[2]['idx'] for e in server.events}
+    assert 2 <= server.connections
+    assert 0 == result['dropped_bytes']
+
+
+@pytest.mark.asyncio
+async def test_concurrent_first_acked_emits():
+    async with StubFluentd(ack=True) as server:
+        sender = aiofluent.sender.FluentSender(
+            'test', port=server.port, require_ack=True)
+        await asyncio.gather(
+            *[sender.async_emit('foo', {'idx': idx}) for idx in range(3)])
+        await server.wait_for_events(3)
+        result = await sender.aclose(timeout=1)
+    # every caller joined the first connect, each frame is written once
+    assert [0, 1, 2] == [e[2]['idx'] for e in server.events]
+    assert 0 == result['dropped_bytes']
+
+
+@pytest.mark.asyncio
+async def test_refused_connects():
+    async with StubFluentd() as server:
+        server.refuse()
+        sender = aiofluent.sender.FluentSender(
+            'test', port=server.port, retry_timeout=0)
+        assert not await sender.async_emit('foo', {'idx': 0})
+        assert isinstance(sender.last_error, ConnectionRefusedError)
+
+        await server.start()
+        # the pending event goes along
+        assert await sender.async_emit('foo', {'idx': 1})
+        events = await server.wait_for_events(2)
+        sender.close()
+    assert [0, 1] == [e[2]['idx'] for e in events]
+
+
+@pytest.mark.asyncio
+async def test_slow_reads_block_drain():
+    async with StubFluentd(read_delay=0.05, read_size=1024) as server:
+        sender = aiofluent.sender.FluentSender(
+            'test', port=server.port, timeout=0.2, bufmax=64 * 1024 * 1024)
+        assert not await sender.async_emit('foo', {'blob': 'x' * 32 * 1024 * 1024})
+        assert isinstance(sender.last_error, asyncio.TimeoutError)
+        sender.close()
+
+
+@pytest.mark.asyncio
+async def test_reset_noticed_without_writing():
+    async with StubFluentd() as server:
+        sender = aiofluent.sender.FluentSender(
+            'test', port=server.port, reconnect_delay=0.01)
+        assert await sender.async_emit('foo', {'idx': 0})
+        server.reset_connections()
+        # the reader notices, nothing is written to the dead connection
+        await asyncio.wait_for(_disconnected(sender), 1)
+        assert not await sender.async_emit('foo', {'idx': 1})
+        events = await server.wait_for_events(2)
+        sender.close()
+    assert [0, 1] == [e[2]['idx'] for e in events]
+    assert 2 == server.connections
+
+
+async def _disconnected(sender):
+    while sender._writer is not None:
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_close_ends_connections(caplog):
+    server = StubFluentd(read_delay=0.01)
+    await server.start()
+    sender = aiofluent.sender.FluentSender('test', port=server.port)
+    assert await sender.async_emit('foo', {'idx': 0})
+    await server.wait_for_events(1)
+    await server.close()
+    await asyncio.sleep(0)
+    # connection handlers were not cancelled, asyncio logged nothing
+    assert not server._tasks
+    assert [] == [r for r in caplog.records if r.name == 'asyncio']
+    sender.close()
+
+
+@pytest.mark.asyncio
+async def test_keepalive():
+    async with StubFluentd() as server:
+        sender = aiofluent.sender.FluentSender(
+            'test', port=server.port, keepalive=30)
+        assert await sender.connect()
+        sock = sender._writer.get_extra_info('socket')
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            assert 30 == sock.getsockopt(
+                socket.IPPROTO_TCP, socket.TCP_KEEPIDLE)
+        sender.close()